@@ -0,0 +1,158 @@
+import glob
+import os
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from inference import StageMeter, report_stages, upscale_batch
+from model_holder import borrow
+from sr_cache import cached_upscale
+
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp', '.tif', '.tiff')
+
+
+def list_images(src):
+    """Image files in directory `src`, or matching `src` when it is a glob pattern, in sorted order."""
+    if os.path.isdir(src):
+        paths = [os.path.join(src, n) for n in os.listdir(src)]
+    else:
+        paths = glob.glob(src, recursive=True)
+    return sorted(p for p in paths if p.lower().endswith(IMAGE_EXTS) and os.path.isfile(p))
+
+
+def input_root(src):
+    """The directory `src` names, or the leading part of the glob pattern `src` before its first wildcard."""
+    if os.path.isdir(src):
+        return src
+    parts = []
+    for part in os.path.normpath(src).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    root = os.sep.join(parts) or (os.sep if os.path.isabs(src) else '.')
+    return root if os.path.isdir(root) else os.path.dirname(root) or '.'
+
+
+def output_paths(paths, src, dst, fmt):
+    """Output path of each input, mirroring its path relative to the root of `src` under `dst`.
+
+    Inputs that only differ in their extension (a.png, a.jpg) keep it in the name (a_png.<fmt>, a_jpg.<fmt>), so
+    no two inputs share an output and resume never mistakes one input's output for another's.
+    """
+    root = input_root(src)
+    rels = [os.path.splitext(os.path.relpath(p, root)) for p in paths]
+    counts = Counter(stem for stem, _ in rels)
+    return [os.path.join(dst, (stem if counts[stem] == 1 else stem + '_' + ext.lstrip('.')) + '.' + fmt) for stem, ext in rels]
+
+
+def make_output_dirs(outputs):
+    for d in sorted(set(os.path.dirname(o) for o in outputs)):
+        os.makedirs(d, exist_ok=True)
+
+
+def _decode(path, meter):
+    with meter.busy():
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.
+
+
+def _encode(out, path, params, meter):
+    # written under a temporary name first, so an interrupted run never leaves a truncated output that resume would skip
+    with meter.busy():
+        root, ext = os.path.splitext(path)
+        tmp = '%s.%d.tmp%s' % (root, os.getpid(), ext)  # cv2 picks the codec from the extension
+        if not cv2.imwrite(tmp, cv2.cvtColor(out, cv2.COLOR_RGB2BGR), params):
+            raise IOError("cannot write %s" % path)
+        os.replace(tmp, path)
+
+
+def upscale_directory(
+    G, src, dst, fmt='png', batch_size=8, tile=128, overlap=8, decode_workers=4, encode_workers=4, queue_size=32, jpeg_quality=95,
+    png_compression=3, scale=4, cache=None
+):
+    """Super-resolves every image in a directory (or glob) into `dst` as PNG or JPEG.
+
+    Outputs mirror the input paths relative to the directory (or the glob root), see `output_paths`.
+    Images are decoded in a pool of `decode_workers` threads and encoded in a pool of `encode_workers` threads
+    while the calling thread runs G, so the three stages overlap (cv2 releases the GIL while decoding and
+    encoding). Decoded images are grouped by shape and each group is run as one batch once it has `batch_size`
+    images; when `queue_size` images are waiting, the largest group is run as is. Inputs whose output already
+    exists are skipped, which resumes an interrupted run. Images found in `cache` (an `SRCache`) skip G.
+    G may be a `ModelHolder`, each batch then runs on the weights that were active when it started.
+    """
+    paths = list_images(src)
+    if not paths:
+        raise IOError("no images found at %s" % src)
+    todo = list(zip(paths, output_paths(paths, src, dst, fmt)))
+    make_output_dirs(o for _, o in todo)
+    todo = [(p, o) for p, o in todo if not os.path.exists(o)]
+    print("[*] %d images, %d already done, %d to go" % (len(paths), len(paths) - len(todo), len(todo)))
+    if fmt.lower() in ('jpg', 'jpeg'):
+        params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+    else:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+
+    read_meter, infer_meter, write_meter = StageMeter('decode'), StageMeter('infer'), StageMeter('encode')
+    pending, encoding, groups = deque(), deque(), OrderedDict()
+    remaining = iter(todo)
+    n_images, n_buffered, n_failed, pixels_in, pixels_out = 0, 0, 0, 0, 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(decode_workers) as decoder, ThreadPoolExecutor(encode_workers) as encoder:
+
+        def refill():
+            while len(pending) + n_buffered < queue_size:
+                item = next(remaining, None)
+                if item is None:
+                    return
+                pending.append((item[0], item[1], decoder.submit(_decode, item[0], read_meter)))
+
+        refill()
+        while pending or groups:
+            if pending:
+                path, out_path, future = pending.popleft()
+                img = future.result()
+                if img is None:
+                    print("[!] cannot decode %s, skipped" % path)
+                    n_failed += 1
+                    refill()
+                    continue
+                groups.setdefault(img.shape, []).append((out_path, img))
+                n_buffered += 1
+                shape = img.shape
+                if len(groups[shape]) < batch_size:
+                    if pending and n_buffered < queue_size:
+                        refill()
+                        continue
+                    shape = max(groups, key=lambda s: len(groups[s]))
+            else:
+                shape = next(iter(groups))
+            batch = groups.pop(shape)
+            n_buffered -= len(batch)
+            refill()
+            with infer_meter.busy(len(batch)), borrow(G) as (g, weights_id):
+                outs = cached_upscale(
+                    cache, [img for _, img in batch], lambda imgs: upscale_batch(g, imgs, tile, overlap, batch_size, scale), weights_id
+                )
+            for (out_path, img), out in zip(batch, outs):
+                encoding.append(encoder.submit(_encode, out, out_path, params, write_meter))
+                pixels_in += img.shape[0] * img.shape[1]
+                pixels_out += out.shape[0] * out.shape[1]
+            n_images += len(batch)
+            while len(encoding) > queue_size:
+                encoding.popleft().result()
+        for future in encoding:
+            future.result()
+
+    elapsed = time.perf_counter() - start
+    report_stages([read_meter, infer_meter, write_meter], elapsed, n_images, unit='images')
+    print("[*] %.2f megapixels/sec in, %.2f megapixels/sec out" % (pixels_in / 1e6 / max(elapsed, 1e-9), pixels_out / 1e6 / max(elapsed, 1e-9)))
+    if n_failed:
+        print("[!] %d images could not be decoded" % n_failed)
+    if cache is not None:
+        cache.report()
+    return n_images
@@ -0,0 +1,268 @@
+"""Micro-benchmarks for the models, the perceptual loss and the data pipeline.
+
+    python benchmark.py                      # run the matrix, write benchmarks/latest.json, compare against the baseline
+    python benchmark.py --update-baseline    # record the current numbers as benchmarks/baseline.json
+
+Each case is timed over `--iters` iterations after `--warmup` untimed ones, throughput is in images/sec.
+A case is flagged as a regression when its throughput drops more than `--tolerance` below the baseline, or
+when it fails while the baseline has numbers for it. Without a baseline the run exits with status 2.
+"""
+import os
+os.environ.setdefault('TL_BACKEND', 'tensorflow')
+import json
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import tensorlayerx as tlx
+from tensorlayerx.model import TrainOneStep
+from tensorlayerx.nn import Module
+
+from config import config
+from gan_losses import WithLoss_D
+from srgan import SRGAN_g, SRGAN_g2, SRGAN_d
+from utils import augment_images, augment_images_valid, psnr_torch
+import vgg
+
+BATCH_SIZES = [1, 4, 16]
+LR_SIZES = [32, 64, 96]  # HR is 4x
+BASELINE = os.path.join('benchmarks', 'baseline.json')
+
+
+def reset_peak_memory():
+    if tlx.BACKEND == 'tensorflow':
+        import tensorflow as tf
+        if tf.config.list_physical_devices('GPU'):
+            tf.config.experimental.reset_memory_stats('GPU:0')
+    elif tlx.BACKEND == 'torch':
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+
+def has_device_memory_stats():
+    """Whether peak_memory_bytes() reads a resettable device counter rather than the process peak RSS."""
+    if tlx.BACKEND == 'tensorflow':
+        import tensorflow as tf
+        return bool(tf.config.list_physical_devices('GPU'))
+    if tlx.BACKEND == 'torch':
+        import torch
+        return torch.cuda.is_available()
+    return False
+
+
+def peak_memory_bytes():
+    """Peak device memory since the last `reset_peak_memory`, or the peak RSS of the process on CPU."""
+    if tlx.BACKEND == 'tensorflow':
+        import tensorflow as tf
+        if tf.config.list_physical_devices('GPU'):
+            return tf.config.experimental.get_memory_info('GPU:0')['peak']
+    elif tlx.BACKEND == 'torch':
+        import torch
+        if torch.cuda.is_available():
+            return torch.cuda.max_memory_allocated()
+    # ru_maxrss is in KB on Linux and never decreases
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def sync(x):
+    # pulling a scalar back to the host waits for the asynchronous kernels that produced x
+    if isinstance(x, (tuple, list)):
+        x = x[-1]
+    if isinstance(x, (float, np.floating, np.ndarray)):
+        return x
+    return tlx.convert_to_numpy(tlx.reduce_sum(x))
+
+
+def time_fn(fn, n_images, warmup, iters):
+    for _ in range(warmup):
+        sync(fn())
+    reset_peak_memory()
+    latencies = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        sync(fn())
+        latencies.append(time.perf_counter() - start)
+    latencies = np.asarray(latencies)
+    return {
+        'throughput': n_images / latencies.mean(),
+        'latency_p50_ms': 1000 * float(np.percentile(latencies, 50)),
+        'latency_p90_ms': 1000 * float(np.percentile(latencies, 90)),
+        'latency_p99_ms': 1000 * float(np.percentile(latencies, 99)),
+        # the process peak RSS never goes down, so on CPU it would only repeat the largest case so far
+        'peak_memory_mb': peak_memory_bytes() / 2**20 if has_device_memory_stats() else None,
+    }
+
+
+class WithLoss(Module):
+
+    def __init__(self, net, loss_fn):
+        super(WithLoss, self).__init__()
+        self.net = net
+        self.loss_fn = loss_fn
+
+    def forward(self, x, target):
+        return tlx.reduce_mean(self.loss_fn(self.net(x), target))
+
+
+def train_step(net, loss_fn):
+    net.set_train()
+    return TrainOneStep(WithLoss(net, loss_fn), optimizer=tlx.optimizers.Momentum(1e-4, 0.9), train_weights=net.trainable_weights)
+
+
+def rand(*shape):
+    return tlx.convert_to_tensor(np.random.uniform(0, 1, shape).astype(np.float32))
+
+
+def generator_cases(name, net, b, r):
+    net.init_build(tlx.nn.Input(shape=(b, r, r, 3)))
+    lr = rand(b, r, r, 3)
+    net.set_eval()
+    hr = rand(*tlx.get_tensor_shape(net(lr)))
+    step = train_step(net, tlx.losses.mean_squared_error)
+    yield name + '/forward', lambda: net(lr)
+    yield name + '/backward', lambda: step(lr, hr)
+
+
+def discriminator_cases(b, r):
+    D = SRGAN_d()
+    D.init_build(tlx.nn.Input(shape=(b, 4 * r, 4 * r, 3)))
+    hr = rand(b, 4 * r, 4 * r, 3)
+    D.set_eval()
+    step = train_step(D, tlx.losses.sigmoid_cross_entropy)
+    labels = tlx.ones_like(D(hr))
+    yield 'SRGAN_d/forward', lambda: D(hr)
+    yield 'SRGAN_d/backward', lambda: step(hr, labels)
+
+
+def perceptual_cases(VGG, b, r):
+    fake, real = rand(b, 4 * r, 4 * r, 3), rand(b, 4 * r, 4 * r, 3)
+    # same expression as WithLoss_G in train.py
+    yield 'vgg19_pool4_loss/forward', lambda: 2e-6 * tlx.losses.mean_squared_error(VGG((fake + 1) / 2.), VGG((real + 1) / 2.))
+
+
+def data_cases(b, r):
+    import tensorflow as tf
+
+    # uint8 tensors like the tf.data pipeline feeds them, so img / 255 is float32 as the degradation kernels expect
+    imgs = [tf.convert_to_tensor(np.random.randint(0, 256, (4 * r, 4 * r, 3), dtype=np.uint8)) for _ in range(b)]
+    yield 'augment_images', lambda: [augment_images(img)[0] for img in imgs][-1]
+    yield 'augment_images_valid', lambda: [augment_images_valid(img)[0] for img in imgs][-1]
+    raw, dst = rand(b, 4 * r, 4 * r, 3), rand(b, 4 * r, 4 * r, 3)
+    yield 'psnr_torch', lambda: psnr_torch(raw, dst)
+
+
+def run(batch_sizes, lr_sizes, warmup, iters, only=None):
+    VGG = vgg.VGG19(pretrained=False, end_with='pool4', mode='dynamic')
+    VGG.set_eval()
+    results = {}
+    for b in batch_sizes:
+        for r in lr_sizes:
+            cases = [
+                generator_cases('SRGAN_g', SRGAN_g(), b, r),
+                generator_cases('SRGAN_g2', SRGAN_g2(), b, r),
+                discriminator_cases(b, r),
+                perceptual_cases(VGG, b, r),
+                data_cases(b, r),
+            ]
+            for group in cases:
+                for name, fn in group:
+                    if only and not any(o in name for o in only):
+                        continue
+                    key = "%s/b%d/lr%d" % (name, b, r)
+                    try:
+                        results[key] = time_fn(fn, b, warmup, iters)
+                    except Exception as e:  # e.g. out of memory at the largest settings
+                        results[key] = {'error': repr(e)}
+                    print("%-42s %s" % (key, json.dumps(results[key])))
+    return results
+
+
+def d_budget(variants, batch_size, hr_size, warmup, iters):
+    """FLOPs, parameters and D training step time of each discriminator variant, relative to the first one."""
+    import model_stats
+
+    rows = []
+    for v in variants:
+        D = SRGAN_d(**v)
+        D.init_build(tlx.nn.Input(shape=(batch_size, hr_size, hr_size, 3)))
+        _, totals = model_stats.analyze(D, (1, hr_size, hr_size, 3), repeat=1)
+        D.set_train()
+        # the training loss with precomputed fake patches, so G is not timed
+        net_with_loss = WithLoss_D(D, None, tlx.losses.sigmoid_cross_entropy)
+        step = TrainOneStep(net_with_loss, optimizer=tlx.optimizers.Momentum(1e-4, 0.9), train_weights=D.trainable_weights)
+        fake, hr = rand(batch_size, hr_size, hr_size, 3), rand(batch_size, hr_size, hr_size, 3)
+        timing = time_fn(lambda: step(fake, hr), batch_size, warmup, iters)
+        rows.append((v, totals['params'], totals['flops'], timing['latency_p50_ms']))
+    base_flops, base_ms = rows[0][2], rows[0][3]
+    print("%-44s %10s %12s %8s %12s %8s" % ("discriminator", "params", "GFLOPs/img", "rel", "D step ms", "rel"))
+    for v, params, flops, ms in rows:
+        print("%-44s %10d %12.2f %7.2fx %12.2f %7.2fx" % (json.dumps(v, sort_keys=True), params, flops / 1e9, flops / base_flops, ms, ms / base_ms))
+    return rows
+
+
+def compare(results, baseline, tolerance):
+    """Returns the keys whose throughput dropped more than `tolerance` (a fraction) below the baseline."""
+    regressions = []
+    for key, base in sorted(baseline['results'].items()):
+        cur = results.get(key)
+        if cur is None or 'throughput' not in base:
+            continue
+        if 'throughput' not in cur:
+            # a case that used to run and now fails is a regression too
+            print("%-42s %10.2f -> %10s img/s  %6s REGRESSION %s" % (key, base['throughput'], '-', '', cur.get('error', '')))
+            regressions.append(key)
+            continue
+        change = cur['throughput'] / base['throughput'] - 1
+        flag = 'REGRESSION' if change < -tolerance else ''
+        print("%-42s %10.2f -> %10.2f img/s  %+6.1f%% %s" % (key, base['throughput'], cur['throughput'], 100 * change, flag))
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=BATCH_SIZES)
+    parser.add_argument('--lr_sizes', type=int, nargs='+', default=LR_SIZES)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--only', type=str, nargs='*', default=None, help='substrings of the case names to run')
+    parser.add_argument('--output', type=str, default=os.path.join('benchmarks', 'latest.json'))
+    parser.add_argument('--baseline', type=str, default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--d-budget', action='store_true', help='only compare the discriminators in config.TRAIN.d_variants')
+    parser.add_argument('--hr_size', type=int, default=256, help='patch size for --d-budget')
+    args = parser.parse_args()
+
+    if args.d_budget:
+        d_budget(config.TRAIN.d_variants, args.batch_sizes[-1], args.hr_size, args.warmup, args.iters)
+        sys.exit(0)
+
+    report = {
+        'meta': {
+            'backend': tlx.BACKEND, 'python': platform.python_version(), 'machine': platform.node(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'warmup': args.warmup, 'iters': args.iters
+        },
+        'results': run(args.batch_sizes, args.lr_sizes, args.warmup, args.iters, args.only),
+    }
+    out = args.baseline if args.update_baseline else args.output
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=4)
+    print("[*] results saved to %s" % out)
+
+    if not args.update_baseline:
+        if not os.path.exists(args.baseline):
+            print("[!] no baseline at %s, nothing was compared; record one on the reference machine with --update-baseline" % args.baseline)
+            sys.exit(2)
+        with open(args.baseline) as f:
+            regressions = compare(report['results'], json.load(f), args.tolerance)
+        if regressions:
+            print("[!] %d regressions" % len(regressions))
+            sys.exit(1)
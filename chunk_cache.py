@@ -0,0 +1,250 @@
+import hashlib
+import os
+import queue
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+Source = namedtuple('Source', ['path', 'size', 'key'])
+
+
+_live_caches = weakref.WeakSet()
+
+
+def _after_fork():
+    # a forked child (e.g. a SharedMemoryLoader worker) inherits the parent's lock, possibly held by the prefetch
+    # thread, and a prefetch queue whose thread does not exist in the child
+    for cache in list(_live_caches):
+        cache._init_threading()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _source(path):
+    st = os.stat(path)
+    key = hashlib.sha256(("%s:%d:%d" % (os.path.abspath(path), st.st_size, st.st_mtime_ns)).encode()).hexdigest()[:16]
+    return Source(path, st.st_size, key)
+
+
+class ChunkCache(object):
+    """Read-through cache of fixed-size chunks of files on slow storage (e.g. a network mount) in a local directory.
+
+    The first read of a byte range copies the `chunk_bytes` chunks it spans to `cache_dir`, later reads are
+    served from there. Chunks are keyed by the source path, size and mtime, so a replaced file is never served
+    stale. The least recently used chunks are evicted above `max_bytes`; like SRCache, recency is the file mtime.
+    Several processes (e.g. the loader workers) may share a directory: the directory is rescanned before each
+    eviction, so `max_bytes` bounds the chunks of all of them together. A background thread fetches the
+    `readahead` chunks after each read and the chunks passed to `schedule()`; forked children get their own.
+    """
+
+    def __init__(self, cache_dir, chunk_bytes=64 * 2**20, max_bytes=8 * 2**30, readahead=2):
+        self.cache_dir = cache_dir
+        self.chunk_bytes = chunk_bytes
+        self.max_bytes = max_bytes
+        self.readahead = readahead
+        self.hits = self.misses = self.evictions = 0
+        self.bytes_fetched = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+        self._init_threading()
+        _live_caches.add(self)
+
+    def _scan(self):
+        # every chunk in the directory, least recently used first, including those written by other processes
+        stats = []
+        for n in os.listdir(self.cache_dir):
+            if n.endswith('.chunk'):
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, n))
+                except OSError:
+                    continue  # evicted meanwhile
+                stats.append((st.st_mtime_ns, os.path.join(self.cache_dir, n), st.st_size))
+        self._entries = OrderedDict((path, size) for _, path, size in sorted(stats))
+        self._bytes = sum(self._entries.values())
+
+    def _init_threading(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._queued = set()
+        self._inflight = {}
+
+    def __getstate__(self):
+        # worker processes get their own lock and prefetch thread
+        state = self.__dict__.copy()
+        for k in ('_lock', '_queue', '_queued', '_inflight'):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_threading()
+        _live_caches.add(self)
+
+    def _chunk_path(self, src, idx):
+        return os.path.join(self.cache_dir, '%s-%08d.chunk' % (src.key, idx))
+
+    def fetch(self, src, idx, prefetch=False):
+        """Makes chunk `idx` of `src` local and returns its path."""
+        path = self._chunk_path(src, idx)
+        if os.path.exists(path):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            with self._lock:
+                if not prefetch:
+                    self.hits += 1
+                if path in self._entries:
+                    self._entries.move_to_end(path)
+            return path
+        with self._lock:
+            event = self._inflight.get(path)
+            owner = event is None
+            if owner:
+                event = self._inflight[path] = threading.Event()
+        if not owner:
+            # the prefetch thread (or another reader) is already copying this chunk
+            event.wait()
+            return self.fetch(src, idx, prefetch)
+        try:
+            with open(src.path, 'rb') as f:
+                data = os.pread(f.fileno(), self.chunk_bytes, idx * self.chunk_bytes)
+            tmp = path + '.%d.%d.tmp' % (os.getpid(), threading.get_ident())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        finally:
+            with self._lock:
+                del self._inflight[path]
+            event.set()
+        with self._lock:
+            if not prefetch:
+                self.misses += 1
+            self.bytes_fetched += len(data)
+            self._bytes += len(data) - self._entries.pop(path, 0)
+            self._entries[path] = len(data)
+            if self._bytes > self.max_bytes:
+                self._scan()
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                old, size = self._entries.popitem(last=False)
+                self._bytes -= size
+                self.evictions += 1
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+        return path
+
+    def read(self, src, offset, length):
+        out = bytearray()
+        end = offset + length
+        while offset < end:
+            idx = offset // self.chunk_bytes
+            start = offset - idx * self.chunk_bytes
+            n = min(end - offset, self.chunk_bytes - start)
+            out += self._read_chunk(src, idx, start, n)
+            offset += n
+        last = (end - 1) // self.chunk_bytes
+        self._enqueue(src, range(last + 1, last + 1 + self.readahead))
+        return bytes(out)
+
+    def _read_chunk(self, src, idx, start, n):
+        for _ in range(3):
+            path = self.fetch(src, idx)
+            try:
+                with open(path, 'rb') as f:
+                    return os.pread(f.fileno(), n, start)
+            except FileNotFoundError:
+                pass  # evicted by another reader between fetch and open
+        raise IOError("chunk %d of %s keeps being evicted, raise max_bytes" % (idx, src.path))
+
+    def schedule(self, src, chunk_ids):
+        """Prefetches chunks in the given order, as far as half of `max_bytes` reaches."""
+        seen, ids = set(), []
+        for idx in chunk_ids:
+            if idx not in seen:
+                seen.add(idx)
+                ids.append(idx)
+        self._enqueue(src, ids[:max(1, self.max_bytes // 2 // self.chunk_bytes)])
+
+    def _enqueue(self, src, ids):
+        n_chunks = -(-src.size // self.chunk_bytes)
+        with self._lock:
+            if self._queue is None:
+                self._queue = queue.Queue()
+                threading.Thread(target=self._prefetch, daemon=True).start()
+            for idx in ids:
+                if idx < n_chunks and (src, idx) not in self._queued and not os.path.exists(self._chunk_path(src, idx)):
+                    self._queued.add((src, idx))
+                    self._queue.put((src, idx))
+
+    def _prefetch(self):
+        while True:
+            src, idx = self._queue.get()
+            try:
+                self.fetch(src, idx, prefetch=True)
+            except OSError as e:
+                print("[!] prefetch of chunk %d of %s failed: %r" % (idx, src.path, e))
+            with self._lock:
+                self._queued.discard((src, idx))
+
+    def report(self):
+        lookups = self.hits + self.misses
+        print("[*] chunk cache hits: %d misses: %d (%.1f%%) fetched: %.1fMB evictions: %d size: %.1fMB" % (
+            self.hits, self.misses, 100. * self.hits / lookups if lookups else 0., self.bytes_fetched / 2**20, self.evictions,
+            self._bytes / 2**20))
+
+
+class CachedNpyArray(object):
+    """Read-only (N, ...) view of a C-ordered .npy file whose bytes come through a ChunkCache.
+
+    Indexes like the memory-mapped array for integers and slices along the first axis.
+    """
+
+    def __init__(self, path, cache):
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                self.shape, fortran_order, self.dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                self.shape, fortran_order, self.dtype = np.lib.format.read_array_header_2_0(f)
+            self.offset = f.tell()
+        if fortran_order:
+            raise ValueError("%s is Fortran ordered, rows are not contiguous" % path)
+        self.cache = cache
+        self.source = _source(path)
+        self.row_bytes = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _rows(self, start, stop):
+        data = self.cache.read(self.source, self.offset + start * self.row_bytes, (stop - start) * self.row_bytes)
+        return np.frombuffer(data, dtype=self.dtype).reshape((stop - start,) + tuple(self.shape[1:]))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                return self._rows(start, max(start, stop))
+            return np.stack([self[j] for j in range(start, stop, step)])
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._rows(i, i + 1)[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def schedule(self, order):
+        """Prefetches the chunks of the rows in `order` (e.g. the shuffled epoch order) in that order."""
+        chunk = self.cache.chunk_bytes
+        starts = self.offset + np.asarray(order, dtype=np.int64) * self.row_bytes
+        ids = np.stack([starts // chunk, (starts + self.row_bytes - 1) // chunk], axis=1).ravel()
+        self.cache.schedule(self.source, [int(i) for i in ids])
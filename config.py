@@ -1,9 +1,13 @@
 from easydict import EasyDict as edict
 import json
+import os
 
 config = edict()
 config.TRAIN = edict()
-config.TRAIN.batch_size = 16 # [16] use 8 if your GPU memory is small
+config.TRAIN.batch_size = 32 # [32] use 8 if your GPU memory is small, or let `--mode tune` pick it
+config.TRAIN.patch_size = 256 # HR crop size, at most the 256x256 of the stored patches
+## written by `--mode tune` and loaded on top of these defaults by train.py
+config.TRAIN.run_config = 'run_config.json'
 config.TRAIN.lr_init = 1e-4
 config.TRAIN.beta1 = 0.9
 
@@ -17,14 +21,140 @@ config.TRAIN.n_epoch = 2000
 config.TRAIN.lr_decay = 0.1
 config.TRAIN.decay_every = int(config.TRAIN.n_epoch / 2)
 
+## discriminator, see SRGAN_d. patch = True drops the Flatten / Linear head so any patch size works
+config.TRAIN.d_dim = 64
+config.TRAIN.d_layers = 6
+config.TRAIN.d_patch = False
+## discriminators compared by `python benchmark.py --d-budget`, the first one is the default
+config.TRAIN.d_variants = [
+    {'dim': 64, 'n_layers': 6, 'patch': False},
+    {'dim': 32, 'n_layers': 6, 'patch': False},
+    {'dim': 64, 'n_layers': 4, 'patch': True},
+    {'dim': 32, 'n_layers': 4, 'patch': True},
+]
+
+## D updates per G update in the adversarial phase, see schedule.DStepScheduler. 'fixed' runs n_critic D steps per G step
+## (fractions accumulate), 'adaptive' also skips D while it separates real / generated easily and adds steps while it falls behind
+config.TRAIN.d_schedule = 'fixed'
+config.TRAIN.n_critic = 1
+config.TRAIN.d_adaptive = edict()
+config.TRAIN.d_adaptive.ema = 0.9 # smoothing of d_loss / accuracy
+config.TRAIN.d_adaptive.acc_high = 0.95 # skip D at or above this accuracy
+config.TRAIN.d_adaptive.acc_low = 0.6 # one extra D step at or below this accuracy
+config.TRAIN.d_adaptive.loss_low = 0.1 # skip D at or below this d_loss
+config.TRAIN.d_adaptive.max_skip = 8 # G steps in a row without a D step
+config.TRAIN.d_adaptive.max_steps = 3 # D steps after one G step
+
 ## train set location
 config.TRAIN.hr_img_path = 'DIV2K/DIV2K_train_HR/'
 config.TRAIN.lr_img_path = 'DIV2K/DIV2K_train_LR_bicubic/X4/'
+## 256x256 HR patches used by TrainData
+config.TRAIN.patches = '/gdrive/MyDrive/Synla_4096.npy' # or a glob of shards written by shards.py, e.g. 'shards/Synla_4096-*.shard'
+## local read-through cache of TRAIN/VALID.patches for slow mounts, None reads the .npy files directly
+config.TRAIN.chunk_cache_dir = None
+config.TRAIN.chunk_bytes = 64 * 2**20
+config.TRAIN.chunk_cache_max_bytes = 8 * 2**30
+config.TRAIN.chunk_readahead = 2 # chunks fetched in the background after the one being read
+## draw crops weighted by a texture index built with texture_index.py, None iterates the patches in order
+config.TRAIN.texture_index = None
+config.TRAIN.texture_floor = 0.1 # relative weight of the flattest crops, 1.0 samples uniformly
+## 'tf' (tf.data + utils.augment_images), 'shm' (worker processes + data.augment_images, any backend),
+## 'tlx' (single process tensorlayerx DataLoader) or 'auto' ('tf' with the tensorflow backend, 'shm' otherwise)
+## the texture index is only used by the 'tf' loader
+config.TRAIN.data_loader = 'auto'
+config.TRAIN.data_workers = 4
+## patch-size curriculum: [(first epoch or step, HR crop size, batch size or None)], None trains at patch_size throughout.
+## Crop sizes are multiples of 4 up to patch_size; changing sizes in the adversarial phase needs d_patch = True
+config.TRAIN.curriculum_init = None # e.g. [(0, 96, 64), (3, 160, 48), (6, 256, None)]
+config.TRAIN.curriculum_adv = None
+config.TRAIN.curriculum_unit = 'epoch' # or 'step', counted from the start of each phase
+## LR / SR / HR grids of the first preview_n validation patches written to samples/ every preview_every steps, 0 disables
+config.TRAIN.preview_every = 500
+config.TRAIN.preview_n = 4
+
+## distillation of a compact SRGAN_g student from the trained models/g.npz teacher
+config.DISTILL = edict()
+config.DISTILL.n_blocks = 6
+config.DISTILL.n_channels = 32
+config.DISTILL.n_epoch = 100
+config.DISTILL.hr_weight = 0.1 # weight of the MSE to the HR patch, the MSE to the teacher output has weight 1
+config.DISTILL.feature_weight = 0.1 # MSE between the (adapted) student and teacher residual trunk features
+## (n_blocks, n_channels) students compared by --mode distill-report
+config.DISTILL.variants = [(16, 64), (8, 64), (6, 32), (4, 32)]
+config.DISTILL.report_shape = (1, 128, 128, 3)
+config.DISTILL.report_batches = 8
+
+## `--mode tune`: trial adversarial steps at increasing batch / patch sizes under a memory ceiling
+config.TUNE = edict()
+config.TUNE.memory_limit_mb = 10 * 1024
+config.TUNE.batch_sizes = [4, 8, 16, 32, 48, 64, 96, 128]
+config.TUNE.patch_sizes = [96, 128, 192, 256]
+config.TUNE.steps = 5
+
+## fine-tuning of the trained models/g.npz to new content with conv1 and the residual blocks frozen, see --mode finetune
+config.FINETUNE = edict()
+config.FINETUNE.patches = None # HR patches of the new domain (.npy or shard glob), None uses config.TRAIN.patches
+config.FINETUNE.n_epoch = 20
+config.FINETUNE.lr = 1e-4
+config.FINETUNE.batch_size = 16
+config.FINETUNE.augment = True # TrainData augmentations; False uses the fixed bicubic x4 degradation and allows caching
+config.FINETUNE.cache_dir = 'finetune_cache' # trunk outputs per patch when augment is False, None recomputes them every step
+config.FINETUNE.adversarial = False # also train against models/d.npz with WithLoss_G, otherwise MSE only
+config.FINETUNE.output = 'g_finetune.npz' # written to the checkpoint directory
+
+## `--mode train-multiscale`: SRGAN_g_multiscale, one scale drawn uniformly per batch
+config.MULTISCALE = edict()
+config.MULTISCALE.scales = [2, 3, 4]
+config.MULTISCALE.n_epoch_init = 10
+config.MULTISCALE.n_epoch = 100
 
 config.VALID = edict()
 ## test set location
 config.VALID.hr_img_path = 'DIV2K/DIV2K_valid_HR/'
 config.VALID.lr_img_path = 'DIV2K/DIV2K_valid_LR_bicubic/X4/'
+config.VALID.patches = '/gdrive/MyDrive/Synla_1024.npy'
+## LR inputs, bicubic baselines and VGG features of VALID.patches, built once by `--mode validate`
+config.VALID.cache_dir = 'valid_cache'
+
+config.INFER = edict()
+## tiled inference, sizes are in LR pixels
+config.INFER.batch_size = 8
+config.INFER.tile_size = 128
+config.INFER.tile_overlap = 8
+config.INFER.cache_dir = None # directory of the super-resolved output cache, None disables it
+config.INFER.cache_max_bytes = 2 * 1024**3
+config.INFER.strip_rows = 448 # rows read per strip in strip mode, a multiple of tile_size - 2 * tile_overlap
+## infer mode (directories of images)
+config.INFER.format = 'png' # png or jpg
+config.INFER.jpeg_quality = 95
+config.INFER.png_compression = 3
+config.INFER.decode_workers = 4
+config.INFER.encode_workers = 4
+config.INFER.queue_size = 32 # images decoded ahead plus images waiting to be encoded
+config.INFER.watch_interval = 5. # seconds between checks of --watch_dir for a new g.npz
+
+config.ADAPTIVE = edict()
+## skip G on tiles whose gradient energy is below the threshold, None disables it in strip mode
+config.ADAPTIVE.threshold = None
+config.ADAPTIVE.thresholds = [0., 0.01, 0.02, 0.04, 0.08] # swept by --mode adaptive
+config.ADAPTIVE.tile_size = 32 # validation patches are only 64x64 LR
+config.ADAPTIVE.tile_overlap = 4
+config.ADAPTIVE.n_images = 64
+
+config.VIDEO = edict()
+config.VIDEO.queue_size = 16 # frames buffered between decode, inference and encode
+config.VIDEO.fourcc = 'mp4v'
+
+def load_run_config(cfg, filename):
+    """Overrides cfg.TRAIN with the values saved in `filename` (by `save_run_config`), if it exists."""
+    if not os.path.exists(filename):
+        return
+    with open(filename) as f:
+        cfg.TRAIN.update(json.load(f))
+
+def save_run_config(filename, values):
+    with open(filename, 'w') as f:
+        json.dump(values, f, indent=4)
 
 def log_config(filename, cfg):
     with open(filename, 'w') as f:
@@ -0,0 +1,216 @@
+"""Multi-process CPU inference: N worker processes, each pinned to its own cores with its own thread pools.
+
+    python cpu_pool.py --sweep --size 256 256 --profile cpu_profile.json   # find the best processes x threads split
+    python cpu_pool.py --input photos/ --output photos_x4/ --profile cpu_profile.json
+    python cpu_pool.py --input photos/ --output photos_x4/ --procs 4 --threads 8
+
+Workers are started with the spawn method and set the affinity mask, the OpenMP / MKL / TensorFlow / PyTorch
+thread counts before tensorlayerx is imported, so the backend thread pools are sized once and never overlap
+other workers' cores. They pull one image at a time from a shared queue, so uneven image sizes balance out.
+This module must not import tensorlayerx at top level, the spawned workers import it.
+"""
+import json
+import multiprocessing as mp
+import os
+import queue
+import time
+
+import numpy as np
+
+from config import config
+
+THREAD_ENV = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS')
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _set_backend_threads(backend, n_threads, n_inter):
+    if backend == 'tensorflow':
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(n_inter)
+    elif backend == 'torch':
+        import torch
+        torch.set_num_threads(n_threads)
+        torch.set_num_interop_threads(n_inter)
+    # paddle and mindspore size their CPU pools from OMP_NUM_THREADS
+
+
+def _worker(rank, cores, n_threads, n_inter, weights, warmup_shape, tasks, results):
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    for var in THREAD_ENV:
+        os.environ[var] = str(n_threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = str(n_inter)
+    os.environ.setdefault('TL_BACKEND', 'tensorflow')
+    import cv2
+    import tensorlayerx as tlx
+    _set_backend_threads(tlx.BACKEND, n_threads, n_inter)
+    cv2.setNumThreads(1)
+    from inference import tiled_upscale, to_uint8
+    from srgan import SRGAN_g
+
+    tile, overlap, batch_size = config.INFER.tile_size, config.INFER.tile_overlap, config.INFER.batch_size
+    G = SRGAN_g()
+    G.init_build(tlx.nn.Input(shape=(None, None, None, 3)))
+    if weights is not None:
+        G.load_weights(weights, format='npz_dict')
+    G.set_eval()
+    tiled_upscale(G, np.random.uniform(0, 1, warmup_shape).astype(np.float32), tile, overlap, batch_size)
+    results.put(('ready', rank, 0))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        src, dst = task
+        try:
+            if src is None:  # sweep: a random image of shape dst
+                img = np.random.uniform(0, 1, dst).astype(np.float32)
+            else:
+                img = cv2.imread(src, cv2.IMREAD_COLOR)
+                if img is None:
+                    raise IOError("cannot decode")
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.
+            out = to_uint8(tiled_upscale(G, img, tile, overlap, batch_size))
+            if src is not None:
+                root, ext = os.path.splitext(dst)
+                tmp = '%s.%d.tmp%s' % (root, os.getpid(), ext)
+                if not cv2.imwrite(tmp, cv2.cvtColor(out, cv2.COLOR_RGB2BGR)):
+                    raise IOError("cannot write %s" % dst)
+                os.replace(tmp, dst)
+            results.put(('done', rank, img.shape[0] * img.shape[1]))
+        except Exception as e:
+            results.put(('error', rank, "%s: %r" % (src, e)))
+
+
+class CPUPool(object):
+    """`n_procs` inference workers with `n_threads` intra-op threads each, pinned to disjoint cores.
+
+    The constructor returns once every worker has loaded the weights and run a warm-up image of `warmup_shape`.
+    """
+
+    def __init__(self, n_procs, n_threads, n_inter=1, weights=None, warmup_shape=(128, 128, 3)):
+        cores = available_cores()
+        if n_procs * n_threads > len(cores):
+            raise ValueError("%d processes x %d threads needs %d cores, only %d available" % (n_procs, n_threads, n_procs * n_threads, len(cores)))
+        ctx = mp.get_context('spawn')
+        self.tasks, self.results = ctx.Queue(), ctx.Queue()
+        self.procs = [
+            ctx.Process(
+                target=_worker, args=(i, cores[i * n_threads:(i + 1) * n_threads], n_threads, n_inter, weights, warmup_shape, self.tasks, self.results),
+                daemon=True
+            ) for i in range(n_procs)
+        ]
+        for p in self.procs:
+            p.start()
+        for _ in self.procs:
+            self._get()
+
+    def _get(self):
+        while True:
+            try:
+                return self.results.get(timeout=1.)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self.procs):
+                    raise RuntimeError("an inference worker died")
+
+    def map(self, tasks):
+        """Runs (src, dst) tasks, returns (images done, input pixels, seconds)."""
+        start = time.perf_counter()
+        for task in tasks:
+            self.tasks.put(task)
+        n_done, pixels = 0, 0
+        for _ in range(len(tasks)):
+            kind, rank, value = self._get()
+            if kind == 'error':
+                print("[!] worker %d: %s" % (rank, value))
+            else:
+                n_done += 1
+                pixels += value
+        return n_done, pixels, time.perf_counter() - start
+
+    def close(self):
+        for _ in self.procs:
+            self.tasks.put(None)
+        for p in self.procs:
+            p.join()
+
+
+def candidate_splits(n_cores):
+    """(processes, threads) pairs using all `n_cores`: every divisor of the core count."""
+    return [(p, n_cores // p) for p in range(1, n_cores + 1) if n_cores % p == 0]
+
+
+def sweep(shape, n_images, weights=None, n_inter=1, output='cpu_profile.json'):
+    """Measures images/sec of every split in candidate_splits() on random images of `shape` and writes the best to `output`."""
+    n_cores = len(available_cores())
+    rows = []
+    print("%6s %8s %12s %10s" % ("procs", "threads", "images/sec", "MP/sec"))
+    for n_procs, n_threads in candidate_splits(n_cores):
+        pool = CPUPool(n_procs, n_threads, n_inter, weights, warmup_shape=shape)
+        try:
+            n_done, pixels, elapsed = pool.map([(None, shape)] * max(n_images, n_procs))
+        finally:
+            pool.close()
+        rows.append({'procs': n_procs, 'threads': n_threads, 'images_per_sec': n_done / elapsed, 'megapixels_per_sec': pixels / 1e6 / elapsed})
+        print("%6d %8d %12.2f %10.3f" % (n_procs, n_threads, rows[-1]['images_per_sec'], rows[-1]['megapixels_per_sec']))
+    best = max(rows, key=lambda r: r['images_per_sec'])
+    with open(output, 'w') as f:
+        json.dump({'cores': n_cores, 'image_shape': list(shape), 'inter_op_threads': n_inter, 'best': best, 'results': rows}, f, indent=4)
+    print("[*] best: %d processes x %d threads (%.2f images/sec), saved to %s" % (best['procs'], best['threads'], best['images_per_sec'], output))
+    return best
+
+
+def upscale_directory(src, dst, n_procs, n_threads, n_inter=1, weights=None, fmt='png'):
+    from batch_infer import list_images, make_output_dirs, output_paths
+
+    paths = list_images(src)
+    tasks = list(zip(paths, output_paths(paths, src, dst, fmt)))
+    make_output_dirs(o for _, o in tasks)
+    tasks = [(p, o) for p, o in tasks if not os.path.exists(o)]
+    print("[*] %d images, %d already done, %d to go on %d processes x %d threads" % (len(paths), len(paths) - len(tasks), len(tasks), n_procs, n_threads))
+    pool = CPUPool(n_procs, n_threads, n_inter, weights, warmup_shape=(config.INFER.tile_size, config.INFER.tile_size, 3))
+    try:
+        n_done, pixels, elapsed = pool.map(tasks)
+    finally:
+        pool.close()
+    print("[*] %d images in %.2fs, %.2f images/sec, %.2f megapixels/sec in" % (n_done, elapsed, n_done / max(elapsed, 1e-9), pixels / 1e6 / max(elapsed, 1e-9)))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sweep', action='store_true', help='measure every processes x threads split and write --profile')
+    parser.add_argument('--size', type=int, nargs=2, default=[256, 256], help='LR image height and width used by --sweep')
+    parser.add_argument('--n_images', type=int, default=64, help='images per split in --sweep')
+    parser.add_argument('--profile', type=str, default='cpu_profile.json', help='written by --sweep, read by inference when --procs is not given')
+    parser.add_argument('--input', type=str, default=None, help='directory or glob of images')
+    parser.add_argument('--output', type=str, default=None, help='output directory')
+    parser.add_argument('--procs', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--inter_op', type=int, default=1, help='inter-op threads per process')
+    parser.add_argument('--weights', type=str, default=os.path.join('models', 'g.npz'))
+    args = parser.parse_args()
+
+    weights = args.weights if os.path.exists(args.weights) else None
+    if args.sweep:
+        if weights is None:
+            print("[!] %s not found, timing randomly initialized weights" % args.weights)
+        sweep((args.size[0], args.size[1], 3), args.n_images, weights, args.inter_op, args.profile)
+    else:
+        if weights is None:
+            raise IOError("weights %s not found" % args.weights)
+        procs, threads = args.procs, args.threads
+        if procs is None:
+            with open(args.profile) as f:
+                best = json.load(f)['best']
+            procs, threads = best['procs'], best['threads']
+        elif threads is None:
+            threads = max(1, len(available_cores()) // procs)
+        upscale_directory(args.input, args.output, procs, threads, args.inter_op, weights, config.INFER.format)
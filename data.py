@@ -0,0 +1,325 @@
+"""Backend-neutral training data: NumPy / cv2 degradations, a tensorlayerx Dataset and a multi-process loader.
+
+The degradations mirror `augment_images` / `augment_images_valid` in utils.py, which are pure TensorFlow,
+so training with the torch or paddle backend no longer depends on tf.data. This module doesn't import
+TensorFlow, but train.py still does through utils.py, so TensorFlow remains a requirement.
+`SharedMemoryLoader` runs the augmentation in worker processes that write whole batches into shared memory
+slots, so batches reach the trainer without being pickled.
+"""
+import multiprocessing as mp
+import queue
+import traceback
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+from tensorlayerx.dataflow import Dataset
+
+from shards import open_patches
+
+RGB_TO_YUV = np.array(
+    [[0.299, 0.587, 0.114], [-0.14714119, -0.28886916, 0.43601035], [0.61497538, -0.51496512, -0.10001026]], dtype=np.float32
+)
+YUV_TO_RGB = np.linalg.inv(RGB_TO_YUV).astype(np.float32)
+
+
+def get_gaussian_kernel(shape=(7, 7), sigma=1.0):
+    m, n = [(sh - 1.0) / 2.0 for sh in shape]
+    x = np.arange(-n, n + 1, dtype=np.float32)[:, np.newaxis]
+    y = np.arange(-m, m + 1, dtype=np.float32)[np.newaxis, :]
+    h = np.exp(-(x * x + y * y) / (2 * sigma * sigma))
+    return h / h.sum()
+
+
+def get_lanczos_kernel(shape=(7, 7), sigma=1.0):
+    m, n = [(sh - 1.0) / 2.0 for sh in shape]
+    x = np.arange(-n, n + 1, dtype=np.float32)[:, np.newaxis]
+    y = np.arange(-m, m + 1, dtype=np.float32)[np.newaxis, :]
+    d = np.sqrt(x * x + y * y)
+    h = np.sinc(d) * np.sinc(d / sigma)
+    return (h / h.sum()).astype(np.float32)
+
+
+def _filter(img, kernel, do_clip=True):
+    # BORDER_REFLECT_101 is tf.pad(mode="REFLECT"), the kernels are symmetric so correlation == convolution
+    img = cv2.filter2D(img, -1, kernel, borderType=cv2.BORDER_REFLECT_101)
+    return np.clip(img, 0, 1) if do_clip else img
+
+
+def degrade_blur_gaussian(img, sigma, shape=(7, 7), do_clip=True):
+    return _filter(img, get_gaussian_kernel(shape, sigma), do_clip)
+
+
+def degrade_ring(img, sigma, shape=(7, 7), do_clip=True):
+    return _filter(img, get_lanczos_kernel(shape, sigma), do_clip)
+
+
+def _jpeg(channel, quality):
+    # same uint8 round trip as tf.image.adjust_jpeg_quality on a single channel image
+    u8 = np.clip(channel * 255 + 0.5, 0, 255).astype(np.uint8)
+    ok, buf = cv2.imencode('.jpg', u8, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    return cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE).astype(np.float32) / 255.
+
+
+def degrade_jpeg(img, quality, chroma_subsampling=True):
+    """RGB -> YUV, optional 2x chroma subsampling, per-channel JPEG, back to RGB (utils.degrade_rgb_to_yuv / degrade_yuv_to_rgb)."""
+    h, w = img.shape[:2]
+    yuv = img @ RGB_TO_YUV.T
+    y, uv = yuv[..., 0], yuv[..., 1:]
+    if chroma_subsampling:
+        uv = cv2.resize(uv, (w // 2, h // 2), interpolation=cv2.INTER_AREA)
+    y = _jpeg(y, quality)
+    uv = np.stack([_jpeg(np.clip(uv[..., c] + 0.5, 0, 1), quality) for c in range(2)], axis=-1)
+    y = np.clip(y, 0, 1)
+    if uv.shape[:2] != (h, w):
+        uv = cv2.resize(uv, (w, h), interpolation=cv2.INTER_CUBIC)
+    yuv = np.concatenate([y[..., np.newaxis], uv - 0.5], axis=-1)
+    return np.clip(yuv @ YUV_TO_RGB.T, 0, 1)
+
+
+def random_hue(img, max_delta, rng):
+    hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)  # float input gives hue in degrees
+    hsv[..., 0] = (hsv[..., 0] + rng.uniform(-max_delta, max_delta) * 360.) % 360.
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+
+
+def random_contrast(img, lower, upper, rng):
+    mean = img.mean(axis=(0, 1), keepdims=True)
+    return (img - mean) * rng.uniform(lower, upper) + mean
+
+
+def augment_images(img, rng=np.random):
+    """NumPy version of utils.augment_images, takes an HWC uint8 patch and returns float32 (lr, hr) in [0, 1]."""
+    img = np.asarray(img, dtype=np.float32) / 255
+
+    img = random_hue(img, 0.5, rng)
+    img = random_contrast(img, 0.5, 2.0, rng)
+    img = np.clip(img, 0, 1)
+
+    if rng.uniform() < 0.5:
+        img = img[:, ::-1]
+    img = np.ascontiguousarray(np.rot90(img, k=rng.randint(4)))
+
+    if rng.uniform() < 0.1:
+        img = degrade_blur_gaussian(img, 1.0, shape=(5, 5))
+
+    lr, jpeg = degrade_lr(img, 4, rng)
+    hr = img
+    if jpeg:
+        #Process hr alongside with lr to prevent mean shift from jpeg and conversion errors
+        hr = degrade_jpeg(hr, 95, chroma_subsampling=False)
+    return lr, hr.astype(np.float32)
+
+
+def degrade_lr(img, scale=4, rng=np.random):
+    """The LR half of augment_images for any `scale`: optional ring / blur, area or bicubic downscale, JPEG 80% of the time.
+
+    Returns the float32 LR and whether JPEG was applied, in which case augment_images also passes the HR through JPEG 95.
+    """
+    lr = img
+    if rng.uniform() < 0.1:
+        lr = degrade_ring(lr, rng.uniform(2.0, 5.0), shape=(5, 5))
+
+    if rng.uniform() < 0.1:
+        lr = degrade_blur_gaussian(lr, rng.uniform(0.1, 0.5), shape=(3, 3))
+
+    size = (img.shape[1] // scale, img.shape[0] // scale)
+    if rng.uniform() < 0.5:
+        lr = cv2.resize(lr, size, interpolation=cv2.INTER_AREA)
+    else:
+        lr = cv2.resize(lr, size, interpolation=cv2.INTER_CUBIC)
+
+    jpeg = rng.uniform() < 0.8
+    if jpeg:
+        lr = degrade_jpeg(lr, rng.randint(70, 90), chroma_subsampling=True)
+    return lr.astype(np.float32), jpeg
+
+
+def augment_images_valid(img):
+    hr = np.asarray(img, dtype=np.float32) / 255
+    lr = cv2.resize(hr, (hr.shape[1] // 4, hr.shape[0] // 4), interpolation=cv2.INTER_CUBIC)
+    return lr, hr
+
+
+class PatchDataset(Dataset):
+    """(lr, hr) pairs from an .npy array of HR patches, or from patch shards (see shards.py).
+
+    The array is memory-mapped lazily so the dataset can be sent to worker processes. `rng` is reseeded
+    per batch by `SharedMemoryLoader`, which keeps the augmentation reproducible whichever worker runs it.
+    """
+
+    def __init__(self, path, train=True, patch_size=None, cache=None):
+        super(PatchDataset, self).__init__()
+        self.path = path
+        self.train = train
+        self.patch_size = patch_size
+        self.cache = cache
+        self.rng = np.random.RandomState()
+        self._patches = None
+
+    @property
+    def patches(self):
+        if self._patches is None:
+            self._patches = open_patches(self.path, self.cache)
+        return self._patches
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_patches'] = None
+        return state
+
+    def __len__(self):
+        return len(self.patches)
+
+    def schedule(self, order):
+        """Passes the upcoming sample order to a chunk cached source for prefetching."""
+        if hasattr(self.patches, 'schedule'):
+            self.patches.schedule(order)
+
+    def __getitem__(self, idx):
+        img = self.patches[idx]
+        if not self.train:
+            return augment_images_valid(img)
+        if self.patch_size is not None and self.patch_size < img.shape[0]:
+            y, x = self.rng.randint(img.shape[0] - self.patch_size + 1), self.rng.randint(img.shape[1] - self.patch_size + 1)
+            img = img[y:y + self.patch_size, x:x + self.patch_size]
+        return augment_images(img, self.rng)
+
+
+def _worker(dataset, task_q, done_q, slot_names, shapes):
+    slots = [shared_memory.SharedMemory(name=n) for n in slot_names]
+    try:
+        while True:
+            task = task_q.get()
+            if task is None:
+                break
+            batch_no, indices, slot, seed = task
+            try:
+                dataset.rng = np.random.RandomState(seed)
+                views = _slot_views(slots[slot], len(indices), shapes)
+                for j, idx in enumerate(indices):
+                    for view, x in zip(views, dataset[idx]):
+                        view[j] = x
+                done_q.put((batch_no, slot, len(indices), None))
+            except Exception:
+                done_q.put((batch_no, slot, 0, traceback.format_exc()))
+    finally:
+        for s in slots:
+            s.close()
+
+
+def _slot_views(shm, n, shapes):
+    views, offset = [], 0
+    for shape in shapes:
+        views.append(np.ndarray((n,) + shape, dtype=np.float32, buffer=shm.buf, offset=offset))
+        offset += n * int(np.prod(shape)) * 4
+    return views
+
+
+class SharedMemoryLoader(object):
+    """Multi-process batch loader handing batches over through shared memory.
+
+    `num_workers` processes each fill whole batches of `dataset` samples into one of `num_workers * prefetch`
+    shared memory slots, the main process copies a finished slot into tensors and hands the slot back.
+    Batches may arrive out of order. Workers are started on first iteration and kept for later epochs.
+    """
+
+    def __init__(self, dataset, batch_size, num_workers=4, shuffle=True, drop_last=True, prefetch=2, seed=0, to_tensor=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.n_slots = max(1, num_workers * prefetch)
+        self.seed = seed
+        self.to_tensor = to_tensor
+        self.epoch = 0
+        self._workers = []
+        self._slots = []
+        self._pending = 0
+
+    def __len__(self):
+        n = len(self.dataset)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+    def _start(self):
+        ctx = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        self.shapes = [np.asarray(x).shape for x in self.dataset[0]]
+        nbytes = self.batch_size * sum(int(np.prod(s)) for s in self.shapes) * 4
+        self._slots = [shared_memory.SharedMemory(create=True, size=nbytes) for _ in range(self.n_slots)]
+        self._task_q, self._done_q = ctx.Queue(), ctx.Queue()
+        for _ in range(self.num_workers):
+            p = ctx.Process(
+                target=_worker, args=(self.dataset, self._task_q, self._done_q, [s.name for s in self._slots], self.shapes), daemon=True
+            )
+            p.start()
+            self._workers.append(p)
+
+    def _batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(len(self.dataset)) if self.shuffle else np.arange(len(self.dataset))
+        return [order[i:i + self.batch_size] for i in range(0, len(self) * self.batch_size, self.batch_size)]
+
+    def _output(self, arrays):
+        if not self.to_tensor:
+            return tuple(np.array(a) for a in arrays)
+        import tensorlayerx as tlx
+        return tuple(tlx.convert_to_tensor(np.array(a)) for a in arrays)
+
+    def _receive(self):
+        while True:
+            try:
+                result = self._done_q.get(timeout=5)
+                self._pending -= 1
+                return result
+            except queue.Empty:
+                if not all(p.is_alive() for p in self._workers):
+                    self.close()
+                    raise RuntimeError("a data loader worker died unexpectedly")
+
+    def __iter__(self):
+        if not self._workers:
+            self._start()
+        # batches still in flight from an epoch that was not iterated to the end
+        while self._pending:
+            self._receive()
+        batches = self._batches()
+        if hasattr(self.dataset, 'schedule') and batches:
+            self.dataset.schedule(np.concatenate(batches))
+        base_seed = (self.seed * 1000003 + self.epoch * len(batches)) % 2**31
+        self.epoch += 1
+        free = list(range(self.n_slots))
+        next_batch, done = 0, 0
+        while done < len(batches):
+            while free and next_batch < len(batches):
+                self._task_q.put((next_batch, [int(i) for i in batches[next_batch]], free.pop(), (base_seed + next_batch) % 2**31))
+                self._pending += 1
+                next_batch += 1
+            batch_no, slot, n, error = self._receive()
+            if error is not None:
+                self.close()
+                raise RuntimeError("data loader worker failed on batch %d:\n%s" % (batch_no, error))
+            out = self._output(_slot_views(self._slots[slot], n, self.shapes))
+            free.append(slot)
+            done += 1
+            yield out
+
+    def close(self):
+        for _ in self._workers:
+            self._task_q.put(None)
+        for p in self._workers:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self._workers = []
+        self._pending = 0
+        for s in self._slots:
+            s.close()
+            s.unlink()
+        self._slots = []
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -0,0 +1,37 @@
+import tensorlayerx as tlx
+from tensorlayerx.nn import Module
+
+import profiling
+
+
+class WithLoss_D(Module):
+    """Discriminator loss of the adversarial phase; also used by `benchmark.py --d-budget`.
+
+    With `G_net=None` the first input is taken as the generated patches, so only D is run (and timed).
+    """
+
+    def __init__(self, D_net, G_net, loss_fn):
+        super(WithLoss_D, self).__init__()
+        self.D_net = D_net
+        self.G_net = G_net
+        self.loss_fn = loss_fn
+
+    def forward(self, lr, hr):
+        if self.G_net is None:
+            fake_patchs = lr
+        else:
+            with profiling.scope('G'):
+                fake_patchs = self.G_net(lr)
+        with profiling.scope('D'):
+            logits_fake = self.D_net(fake_patchs)
+            logits_real = self.D_net(hr)
+        with profiling.scope('loss'):
+            d_loss1 = self.loss_fn(logits_real, tlx.ones_like(logits_real))
+            d_loss1 = tlx.ops.reduce_mean(d_loss1)
+            d_loss2 = self.loss_fn(logits_fake, tlx.zeros_like(logits_fake))
+            d_loss2 = tlx.ops.reduce_mean(d_loss2)
+            d_loss = d_loss1 + d_loss2
+            # share of real / generated patches D gets right, read by the adaptive D schedule
+            self.last_accuracy = (tlx.ops.reduce_mean(tlx.cast(logits_real > 0, tlx.float32)) +
+                                  tlx.ops.reduce_mean(tlx.cast(logits_fake < 0, tlx.float32))) / 2.
+        return d_loss
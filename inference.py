@@ -0,0 +1,152 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+import tensorlayerx as tlx
+
+
+class StageMeter(object):
+    """Accumulates the busy time and item count of one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.busy_time = 0.
+        self.items = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def busy(self, items=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.busy_time += time.perf_counter() - start
+                self.items += items
+
+    def utilization(self, wall_time):
+        return self.busy_time / wall_time if wall_time > 0 else 0.
+
+
+def report_stages(meters, wall_time, n_items, unit='frames'):
+    print("[*] %d %s in %.2fs, %.2f %s/sec" % (n_items, unit, wall_time, n_items / max(wall_time, 1e-9), unit))
+    for m in meters:
+        print("    %-8s busy: %.2fs  utilization: %5.1f%%" % (m.name, m.busy_time, 100 * m.utilization(wall_time)))
+
+
+def to_uint8(img):
+    # generator output is in [0, 1], see evaluate()
+    return np.clip(img * 255, 0, 255).astype(np.uint8)
+
+
+def run_generator(G, lr_batch):
+    """Runs G on a float32 NHWC batch with range [0, 1] and returns the output as a NumPy array."""
+    lr_batch = tlx.ops.convert_to_tensor(np.ascontiguousarray(lr_batch, dtype=np.float32))
+    return tlx.ops.convert_to_numpy(G(lr_batch))
+
+
+def extract_tiles(img, tile, overlap):
+    """Cuts an HWC image into overlapping tiles of identical size so that they can be batched.
+
+    The image is reflect padded by `overlap` on every side (plus up to one tile on the bottom / right),
+    each tile covers a core of `tile - 2 * overlap` pixels and its origin is returned in image coordinates.
+    """
+    core = tile - 2 * overlap
+    if core <= 0:
+        raise ValueError("tile size %d is too small for overlap %d" % (tile, overlap))
+    h, w = img.shape[:2]
+    n_y, n_x = -(-h // core), -(-w // core)
+    padded = np.pad(img, ((overlap, overlap + n_y * core - h), (overlap, overlap + n_x * core - w), (0, 0)), mode='reflect')
+    coords = [(y, x) for y in range(0, n_y * core, core) for x in range(0, n_x * core, core)]
+    return padded, coords
+
+
+def tiled_upscale(G, img, tile=128, overlap=8, batch_size=8, scale=4):
+    """Super-resolves a single HWC float image in [0, 1], batching tiles through G when it is larger than one tile."""
+    h, w = img.shape[:2]
+    if h <= tile and w <= tile:
+        return run_generator(G, img[np.newaxis])[0]
+    padded, coords = extract_tiles(img, tile, overlap)
+    core = tile - 2 * overlap
+    o, c = overlap * scale, core * scale
+    out = np.empty(((-(-h // core)) * c, (-(-w // core)) * c, img.shape[2]), dtype=np.float32)
+    for i in range(0, len(coords), batch_size):
+        chunk = coords[i:i + batch_size]
+        sr = run_generator(G, np.stack([padded[y:y + tile, x:x + tile] for y, x in chunk]))
+        for (y, x), t in zip(chunk, sr):
+            out[y * scale:y * scale + c, x * scale:x * scale + c] = t[o:o + c, o:o + c]
+    return out[:h * scale, :w * scale]
+
+
+def upscale_batch(G, imgs, tile=128, overlap=8, batch_size=8, scale=4):
+    """Super-resolves a list of same-shape HWC float images, stacking them into one G call when they fit in a tile."""
+    h, w = imgs[0].shape[:2]
+    if h <= tile and w <= tile:
+        out = []
+        for i in range(0, len(imgs), batch_size):
+            out.extend(run_generator(G, np.stack(imgs[i:i + batch_size])))
+        return out
+    return [tiled_upscale(G, img, tile, overlap, batch_size, scale) for img in imgs]
+
+
+def tile_scores(padded, coords, tile):
+    """Gradient energy (mean absolute luma difference) of each tile, a cheap measure of how textured it is."""
+    scores = []
+    for y, x in coords:
+        t = padded[y:y + tile, x:x + tile]
+        luma = t[..., 0] * 0.299 + t[..., 1] * 0.587 + t[..., 2] * 0.114
+        scores.append(np.abs(np.diff(luma, axis=0)).mean() + np.abs(np.diff(luma, axis=1)).mean())
+    return np.asarray(scores)
+
+
+def blend_window(size, ramp):
+    """Separable weights that fall off linearly over `ramp` pixels on every border, neighbouring windows sum to one."""
+    if ramp <= 0:
+        return np.ones((size, size, 1), dtype=np.float32)
+    i = np.arange(size, dtype=np.float32) + 0.5
+    w = np.clip(i / ramp, 0, 1) * np.clip((size - i) / ramp, 0, 1)
+    return (w[:, np.newaxis] * w[np.newaxis, :])[..., np.newaxis]
+
+
+def interpolate_tile(padded, y, x, tile, scale, margin=2):
+    """Bicubic upscale of one tile of `padded`, computed with `margin` pixels of context so its borders are not clamped."""
+    y0, x0 = max(y - margin, 0), max(x - margin, 0)
+    y1, x1 = min(y + tile + margin, padded.shape[0]), min(x + tile + margin, padded.shape[1])
+    up = cv2.resize(padded[y0:y1, x0:x1], ((x1 - x0) * scale, (y1 - y0) * scale), interpolation=cv2.INTER_CUBIC)
+    dy, dx = (y - y0) * scale, (x - x0) * scale
+    return up[dy:dy + tile * scale, dx:dx + tile * scale]
+
+
+def adaptive_upscale(G, img, threshold, tile=128, overlap=8, batch_size=8, scale=4):
+    """Tiled inference that only sends textured tiles through G.
+
+    Tiles whose gradient energy is below `threshold` use a bicubic upscale of the tile and its overlap instead.
+    All tiles are blended with `blend_window` over their overlap so there are no seams between generated and
+    interpolated tiles. Besides the output, only a one-channel weight sum of the same size is allocated.
+    Returns the output, the number of tiles that skipped G and the number of tiles.
+    """
+    h, w = img.shape[:2]
+    padded, coords = extract_tiles(img, tile, overlap)
+    scores = tile_scores(padded, coords, tile)
+    textured = [c for c, score in zip(coords, scores) if score >= threshold]
+    flat = [c for c, score in zip(coords, scores) if score < threshold]
+
+    size = tile * scale
+    window = blend_window(size, 2 * overlap * scale)
+    acc = np.zeros((padded.shape[0] * scale, padded.shape[1] * scale, img.shape[2]), dtype=np.float32)
+    wsum = np.zeros(acc.shape[:2] + (1,), dtype=np.float32)
+    for y, x in flat:
+        acc[y * scale:y * scale + size, x * scale:x * scale + size] += interpolate_tile(padded, y, x, tile, scale) * window
+        wsum[y * scale:y * scale + size, x * scale:x * scale + size] += window
+    for i in range(0, len(textured), batch_size):
+        chunk = textured[i:i + batch_size]
+        sr = run_generator(G, np.stack([padded[y:y + tile, x:x + tile] for y, x in chunk]))
+        for (y, x), t in zip(chunk, sr):
+            acc[y * scale:y * scale + size, x * scale:x * scale + size] += t * window
+            wsum[y * scale:y * scale + size, x * scale:x * scale + size] += window
+    o = overlap * scale
+    out = acc[o:o + h * scale, o:o + w * scale]
+    out /= wsum[o:o + h * scale, o:o + w * scale]
+    return out, len(flat), len(coords)
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import threading
+import time
+import zipfile
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+import tensorlayerx as tlx
+
+
+def mmap_npz(path):
+    """Returns the arrays of an .npz file in stored order, memory-mapped instead of read.
+
+    `save_weights(format='npz_dict')` writes an uncompressed zip (np.savez), so each member is a plain .npy
+    file at a fixed offset and can be mapped directly; compressed members fall back to a normal read.
+    """
+    arrays = []
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    arrays.append(np.lib.format.read_array(member))
+                continue
+            # local file header: 30 fixed bytes, then the name and extra field, whose lengths are at bytes 26-29
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + int(name_len) + int(extra_len))
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError("%s: object arrays cannot be memory-mapped" % info.filename)
+            order = 'F' if fortran_order else 'C'
+            if int(np.prod(shape)) == 0:
+                arrays.append(np.empty(shape, dtype=dtype, order=order))
+            else:
+                arrays.append(np.memmap(f.name, dtype=dtype, mode='r', shape=shape, order=order, offset=f.tell()))
+    return arrays
+
+
+def weights_digest(values):
+    """Hex digest of a list of weight arrays, identifies the weights a generator runs on (e.g. for SRCache keys)."""
+    h = hashlib.sha256()
+    for v in values:
+        h.update(("%s%s" % (v.shape, v.dtype)).encode())
+        h.update(np.ascontiguousarray(v).data)
+    return h.hexdigest()
+
+
+def load_weights_in_order(net, path, mmap=False):
+    """Loads an npz_dict checkpoint by position instead of by name and returns the arrays.
+
+    Layer names come from global counters, so a model built in a different order than when it was saved
+    (e.g. several students in one process) has different weight names but the same weight order. With `mmap`
+    the arrays are memory-mapped (see mmap_npz) instead of read.
+    """
+    if mmap:
+        values = mmap_npz(path)
+    else:
+        weights = np.load(path)
+        values = [weights[k] for k in weights.files]
+    if len(values) != len(net.all_weights):
+        raise ValueError("%s holds %d weights, the model has %d" % (path, len(values), len(net.all_weights)))
+    for w, v in zip(net.all_weights, values):
+        if tuple(tlx.get_tensor_shape(w)) != v.shape:
+            raise ValueError("%s: shape %s does not match %s in %s" % (w.name, tlx.get_tensor_shape(w), v.shape, path))
+    tlx.files.assign_weights(values, net)
+    return values
+
+
+class ModelHolder(object):
+    """Serves one of two generator instances and swaps in new weights without stopping inference.
+
+    Callers wrap each request in `with holder.acquire() as (G, weights_id):`, so a request runs on a single set of
+    weights from start to end; `weights_id` is the `weights_digest` of the arrays loaded into that instance, which
+    is what outputs of the request must be keyed by (the file on disk may already have been replaced). `load()`
+    fills the standby instance from a memory-mapped checkpoint, warms it up on `warmup_shape` and then makes it
+    the active one under the lock. The previous instance stays valid for the requests still holding it and only
+    becomes the target of the next load once they have finished.
+    """
+
+    def __init__(self, make_generator, weights_path, warmup_shape=(1, 64, 64, 3)):
+        self.warmup_shape = warmup_shape
+        self._models = [make_generator(), make_generator()]
+        for G in self._models:
+            G.init_build(tlx.nn.Input(shape=(None, None, None, 3)))
+            G.set_eval()
+        self._refs = [0, 0]
+        self._digests = [None, None]
+        self._active = 1
+        self._cond = threading.Condition()
+        self._load_lock = threading.Lock()
+        self.weights_path = None
+        self.swaps = 0
+        self.load(weights_path)
+
+    @contextmanager
+    def acquire(self):
+        with self._cond:
+            i = self._active
+            self._refs[i] += 1
+        try:
+            yield self._models[i], self._digests[i]
+        finally:
+            with self._cond:
+                self._refs[i] -= 1
+                self._cond.notify_all()
+
+    def load(self, weights_path):
+        with self._load_lock:
+            standby = 1 - self._active
+            with self._cond:
+                self._cond.wait_for(lambda: self._refs[standby] == 0)
+            start = time.perf_counter()
+            G = self._models[standby]
+            self._digests[standby] = weights_digest(load_weights_in_order(G, weights_path, mmap=True))
+            tlx.ops.convert_to_numpy(G(tlx.ops.convert_to_tensor(np.zeros(self.warmup_shape, dtype=np.float32))))
+            with self._cond:
+                self._active = standby
+                self.weights_path = weights_path
+                self.swaps += 1
+            print("[*] serving %s (loaded and warmed up in %.2fs)" % (weights_path, time.perf_counter() - start))
+
+
+def borrow(G):
+    """`with borrow(G) as (g, weights_id):` gives the active generator of a ModelHolder and the digest of its weights,
+    or G itself and None for a plain model."""
+    if isinstance(G, ModelHolder):
+        return G.acquire()
+    return nullcontext((G, None))
+
+
+class CheckpointWatcher(object):
+    """Polls `directory` for a new `filename` and loads it into `holder`.
+
+    A checkpoint is loaded once its size and mtime have been the same for two polls, so a file that is still
+    being written is not picked up. A load that fails (e.g. a truncated file) is retried at the next change.
+    """
+
+    def __init__(self, holder, directory, filename='g.npz', interval=5.):
+        self.holder = holder
+        self.path = os.path.join(directory, filename)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._loaded = self._stat()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def _run(self):
+        seen = self._loaded
+        while not self._stop.wait(self.interval):
+            current = self._stat()
+            if current is None or current == self._loaded:
+                seen = current
+                continue
+            if current != seen:
+                seen = current  # still changing, check again at the next poll
+                continue
+            try:
+                self.holder.load(self.path)
+            except Exception as e:
+                print("[!] cannot load %s: %r" % (self.path, e))
+            self._loaded = current
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,153 @@
+"""Per-layer FLOPs, parameters, activation memory and measured time of the srgan.py / vgg.py models.
+
+    python model_stats.py --model SRGAN_g --shape 1 96 96 3
+    python model_stats.py --model SRGAN_d --shape 16 256 256 3 --json d.json
+
+FLOPs count a multiply-add as two operations and cover convolutions, linear layers, normalization,
+pooling, upsampling and element-wise adds; activations fused into a layer add one per output element.
+Times are measured in eval mode and synchronized after every layer, so they add up to more than a normal
+forward pass but show where it is spent.
+"""
+import os
+os.environ.setdefault('TL_BACKEND', 'tensorflow')
+import json
+import time
+from collections import OrderedDict
+
+import numpy as np
+import tensorlayerx as tlx
+
+import srgan
+import vgg
+
+MODELS = {
+    'SRGAN_g': srgan.SRGAN_g,
+    'SRGAN_g2': srgan.SRGAN_g2,
+    'SRGAN_g_multiscale': srgan.SRGAN_g_multiscale,  # timed at x4
+    'SRGAN_d': srgan.SRGAN_d,
+    'SRGAN_d2': srgan.SRGAN_d2,
+    'vgg19_pool4': lambda: vgg.VGG19(pretrained=False, end_with='pool4', mode='dynamic'),
+}
+
+
+def _shape(x):
+    if isinstance(x, (list, tuple)):
+        x = x[0]
+    return [int(d) for d in tlx.get_tensor_shape(x)]
+
+
+def _numel(shape):
+    return int(np.prod(shape)) if shape else 0
+
+
+def _sync(x):
+    if isinstance(x, (list, tuple)):
+        x = x[0]
+    tlx.convert_to_numpy(tlx.reduce_sum(x))
+
+
+def layer_flops(layer, in_shape, out_shape, n_inputs=1):
+    kind = type(layer).__name__
+    out = _numel(out_shape)
+    flops = 0
+    if kind.startswith('Conv'):
+        kh, kw = layer.kernel_size if isinstance(layer.kernel_size, (list, tuple)) else (layer.kernel_size,) * 2
+        positions = out // layer.out_channels
+        flops = 2 * kh * kw * layer.in_channels * layer.out_channels * positions
+        if getattr(layer, 'b_init', None) is not None:
+            flops += out
+    elif kind == 'Linear':
+        flops = 2 * layer.in_features * layer.out_features * out_shape[0] + out
+    elif kind.startswith('BatchNorm'):
+        flops = 4 * out
+    elif kind.startswith('MaxPool'):
+        kh, kw = layer.kernel_size if isinstance(layer.kernel_size, (list, tuple)) else (layer.kernel_size,) * 2
+        flops = kh * kw * out
+    elif kind.startswith('UpSampling'):
+        flops = 4 * out
+    elif kind == 'Elementwise':
+        flops = (n_inputs - 1) * out
+    if getattr(layer, 'act', None) is not None:
+        flops += out
+    return flops
+
+
+def layer_params(layer):
+    return sum(_numel(_shape(w)) for w in layer.trainable_weights or [])
+
+
+def leaf_layers(model):
+    return [(name, m) for name, m in model.named_modules() if name and not list(m.children())]
+
+
+def analyze(model, input_shape, repeat=3):
+    """Runs `model` on a random input of `input_shape` and returns per-layer records in call order plus totals."""
+    model.set_eval()
+    x = tlx.convert_to_tensor(np.random.uniform(0, 1, input_shape).astype(np.float32))
+    _sync(model(x))  # builds lazily shaped weights and warms up
+
+    records = OrderedDict()
+
+    def instrument(name, layer):
+        forward = layer.forward
+
+        def timed(inputs, *args, **kwargs):
+            start = time.perf_counter()
+            out = forward(inputs, *args, **kwargs)
+            _sync(out)
+            elapsed = time.perf_counter() - start
+            if name not in records:
+                n_inputs = len(inputs) if isinstance(inputs, (list, tuple)) else 1
+                in_shape, out_shape = _shape(inputs), _shape(out)
+                records[name] = {
+                    'type': type(layer).__name__,
+                    'output_shape': out_shape,
+                    'params': layer_params(layer),
+                    'flops': layer_flops(layer, in_shape, out_shape, n_inputs),
+                    'activation_bytes': _numel(out_shape) * 4,
+                    'time_ms': 0.,
+                }
+            records[name]['time_ms'] += 1000 * elapsed / repeat
+            return out
+
+        layer.forward = timed
+
+    layers = leaf_layers(model)
+    for name, layer in layers:
+        instrument(name, layer)
+    try:
+        for _ in range(repeat):
+            model(x)
+    finally:
+        for _, layer in layers:
+            del layer.forward
+
+    totals = {k: sum(r[k] for r in records.values()) for k in ('params', 'flops', 'activation_bytes', 'time_ms')}
+    return records, totals
+
+
+def print_report(records, totals):
+    print("%-36s %-16s %-22s %10s %10s %10s %9s %6s" % ("layer", "type", "output", "params", "MFLOPs", "act MB", "ms", "time"))
+    for name, r in records.items():
+        print("%-36s %-16s %-22s %10d %10.1f %10.2f %9.3f %5.1f%%" % (
+            name[-36:], r['type'], r['output_shape'], r['params'], r['flops'] / 1e6, r['activation_bytes'] / 2**20, r['time_ms'],
+            100 * r['time_ms'] / max(totals['time_ms'], 1e-9)))
+    print("%-36s %-16s %-22s %10d %10.1f %10.2f %9.3f" % (
+        "total", "", "", totals['params'], totals['flops'] / 1e6, totals['activation_bytes'] / 2**20, totals['time_ms']))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='SRGAN_g', help=', '.join(MODELS))
+    parser.add_argument('--shape', type=int, nargs='+', default=[1, 96, 96, 3], help='input shape, NHWC for the srgan.py models')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', type=str, default=None, help='also write the records to this file')
+    args = parser.parse_args()
+
+    records, totals = analyze(MODELS[args.model](), args.shape, args.repeat)
+    print_report(records, totals)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'model': args.model, 'input_shape': args.shape, 'layers': records, 'totals': totals}, f, indent=4)
@@ -0,0 +1,73 @@
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+import tensorlayerx as tlx
+from PIL import Image
+
+from data import augment_images_valid
+from inference import run_generator, to_uint8
+from shards import open_patches
+
+
+def comparison_grid(lr, sr, hr):
+    """One row per sample: nearest-upscaled LR | SR | HR, as a uint8 image."""
+    rows = []
+    for l, s, h in zip(lr, sr, hr):
+        l = cv2.resize(l, (h.shape[1], h.shape[0]), interpolation=cv2.INTER_NEAREST)
+        rows.append(np.concatenate([l, s, h], axis=1))
+    return to_uint8(np.concatenate(rows, axis=0))
+
+
+class PreviewWriter(object):
+    """Writes LR / SR / HR comparison grids of a fixed sample set every `every` steps without blocking training.
+
+    At a preview step only the generator weights are copied to host memory. A worker thread loads them into
+    its own snapshot generator, runs the fixed LR set through it and encodes the PNG. If the previous preview
+    is still being written the new one is skipped instead of waiting.
+    """
+
+    def __init__(self, make_generator, save_dir, patches_path, n_images=4, every=500):
+        self.save_dir = save_dir
+        self.every = every
+        self.skipped = 0
+        patches = open_patches(patches_path)
+        pairs = [augment_images_valid(img) for img in patches[:n_images]]
+        self.lr = np.stack([lr for lr, _ in pairs])
+        self.hr = np.stack([hr for _, hr in pairs])
+        self.G_snap = make_generator()
+        self.G_snap.init_build(tlx.nn.Input(shape=(None, None, None, 3)))
+        self.G_snap.set_eval()
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def maybe_write(self, G, step, name):
+        if step % self.every != 0:
+            return
+        if self._queue.full():
+            self.skipped += 1
+            return
+        weights = [tlx.convert_to_numpy(w) for w in G.all_weights]
+        self._queue.put_nowait((name, weights))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            name, weights = item
+            try:
+                tlx.files.assign_weights(weights, self.G_snap)
+                sr = run_generator(self.G_snap, self.lr)
+                Image.fromarray(comparison_grid(self.lr, np.clip(sr, 0, 1), self.hr)).save(os.path.join(self.save_dir, name + '.png'))
+            except Exception as e:
+                print("[!] preview %s failed: %r" % (name, e))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self.skipped:
+            print("[*] %d previews skipped while the previous one was being written" % self.skipped)
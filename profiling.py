@@ -0,0 +1,140 @@
+import os
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import tensorflow as tf
+import tensorlayerx as tlx
+
+from utils import degrade_blur_gaussian, degrade_ring, degrade_rgb_to_yuv, degrade_yuv_to_rgb
+
+
+def _jpeg(img, quality, subsample):
+    return degrade_yuv_to_rgb(degrade_rgb_to_yuv(img, jpeg_factor=quality, chroma_subsampling=subsample, chroma_method="area"))
+
+
+def _resize(method):
+    return lambda img: tf.image.resize(img, [tf.shape(img)[-3] // 4, tf.shape(img)[-2] // 4], method=method)
+
+
+# (name, probability per image in augment_images, input ('hr' or 'lr'), transform), keep in sync with utils.augment_images
+TRANSFORMS = [
+    ('hue/contrast', 1.0, 'hr', lambda img: tf.clip_by_value(tf.image.random_contrast(tf.image.random_hue(img, 0.5), 0.5, 2.0), 0, 1)),
+    ('flip/rot90', 1.0, 'hr', lambda img: tf.image.rot90(tf.image.random_flip_left_right(img), k=1)),
+    ('blur 5x5', 0.1, 'hr', lambda img: degrade_blur_gaussian(img, 1.0, shape=(5, 5))),
+    ('ring 5x5', 0.1, 'hr', lambda img: degrade_ring(img, 3.5, shape=(5, 5))),
+    ('blur 3x3', 0.1, 'hr', lambda img: degrade_blur_gaussian(img, 0.3, shape=(3, 3))),
+    ('resize area', 0.5, 'hr', _resize("area")),
+    ('resize bicubic', 0.5, 'hr', _resize("bicubic")),
+    ('jpeg lr q80', 0.8, 'lr', lambda img: _jpeg(img, 80, True)),
+    ('jpeg hr q95', 0.8, 'hr', lambda img: _jpeg(img, 95, False)),
+]
+
+
+def profile_transforms(hr_imgs, repeat=3):
+    """Times each augmentation on its own (eagerly, one image at a time).
+
+    Returns rows of (name, probability, ms per call, expected ms per image), the last one being the
+    probability weighted cost that the transform adds to every image drawn from the training set.
+    """
+    hr_imgs = [tf.convert_to_tensor(np.asarray(img, dtype=np.float32) / 255.) for img in hr_imgs]
+    lr_imgs = [_resize("area")(img) for img in hr_imgs]
+    rows = []
+    for name, prob, kind, fn in TRANSFORMS:
+        imgs = hr_imgs if kind == 'hr' else lr_imgs
+        fn(imgs[0]).numpy()  # warm up
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for img in imgs:
+                fn(img).numpy()
+        ms = 1000 * (time.perf_counter() - start) / (repeat * len(imgs))
+        rows.append((name, prob, ms, prob * ms))
+    return rows
+
+
+def drain(dataset, n_batches):
+    """Pulls up to `n_batches` batches without running a model, returns (images, seconds)."""
+    it = iter(dataset)
+    next(it)  # the first batch includes pipeline start-up
+    n_images, start = 0, time.perf_counter()
+    for _, (lr, hr) in zip(range(n_batches), it):
+        n_images += int(hr.shape[0])
+    return n_images, time.perf_counter() - start
+
+
+def stall_fraction(images_per_sec, batch_size, step_time):
+    """Fraction of wall time the trainer would wait on data, assuming prefetch fully overlaps data and compute."""
+    data_time = batch_size / images_per_sec
+    stall = max(0., data_time - step_time)
+    return stall / (step_time + stall)
+
+
+_NULL_SCOPE = nullcontext()
+_tracing = False
+
+
+def scope(name):
+    """Names a region (G, D, VGG, loss) in the trace. Returns a shared no-op context unless a trace is being captured."""
+    if not _tracing:
+        return _NULL_SCOPE
+    if tlx.BACKEND == 'torch':
+        import torch
+        return torch.profiler.record_function(name)
+    if tlx.BACKEND == 'paddle':
+        import paddle
+        return paddle.profiler.RecordEvent(name)
+    return tf.profiler.experimental.Trace(name)
+
+
+class TraceWindow(object):
+    """Runs the backend profiler for steps [start, start + n_steps) of one training phase ('init' or 'adv').
+
+    Step numbers count from 0 over the whole phase, not per epoch. Traces are written under `logdir`
+    (TensorBoard profile plugin for TensorFlow and PyTorch, chrome tracing for Paddle).
+    """
+
+    def __init__(self, phase, start, n_steps, logdir):
+        if phase not in ('init', 'adv'):
+            raise ValueError("unknown profile phase %s, use init or adv" % phase)
+        self.phase = phase
+        self.start = start
+        self.stop_at = start + n_steps
+        self.logdir = logdir
+        self._profiler = None
+
+    def step(self, phase, step):
+        if phase != self.phase:
+            return
+        if step == self.start:
+            self._start()
+        elif step == self.stop_at:
+            self.close()
+
+    def _start(self):
+        global _tracing
+        os.makedirs(self.logdir, exist_ok=True)
+        if tlx.BACKEND == 'torch':
+            import torch
+            self._profiler = torch.profiler.profile(on_trace_ready=torch.profiler.tensorboard_trace_handler(self.logdir))
+            self._profiler.__enter__()
+        elif tlx.BACKEND == 'paddle':
+            import paddle
+            self._profiler = paddle.profiler.Profiler(on_trace_ready=paddle.profiler.export_chrome_tracing(self.logdir))
+            self._profiler.start()
+        else:
+            tf.profiler.experimental.start(self.logdir)
+            self._profiler = tf.profiler.experimental
+        _tracing = True
+        print("[*] profiling %s steps %d-%d into %s" % (self.phase, self.start, self.stop_at - 1, self.logdir))
+
+    def close(self):
+        global _tracing
+        if self._profiler is None:
+            return
+        if tlx.BACKEND == 'torch':
+            self._profiler.__exit__(None, None, None)
+        else:
+            self._profiler.stop()
+        self._profiler = None
+        _tracing = False
+        print("[*] trace written to %s" % self.logdir)
@@ -0,0 +1,144 @@
+"""Training schedules: the patch-size curriculum of the init / adversarial phases and the D update schedule."""
+import time
+
+
+class Curriculum(object):
+    """Piecewise-constant HR crop size / batch size schedule of one training phase.
+
+    `stages` is a list of (start, patch_size, batch_size) sorted by start, which counts epochs or steps of the
+    phase depending on `unit`. A batch_size of None keeps `batch_size`; no stages gives a single stage of
+    (`patch_size`, `batch_size`). `build(patch_size, batch_size)` makes whatever a stage needs (the dataset and
+    the TrainOneStep objects) and must return the dataset first; it runs once per stage change.
+    """
+
+    def __init__(self, stages, patch_size, batch_size, build, unit='epoch', name=''):
+        if unit not in ('epoch', 'step'):
+            raise ValueError("unknown curriculum unit %s, use epoch or step" % unit)
+        stages = sorted(stages or [], key=lambda s: s[0])
+        if not stages or stages[0][0] > 0:
+            stages.insert(0, (0, patch_size, batch_size))
+        for start, patch, _ in stages:
+            if patch % 4 or patch > patch_size:
+                raise ValueError("curriculum crop %d must be a multiple of 4 and at most patch_size %d" % (patch, patch_size))
+        self.stages = [(start, patch, batch or batch_size) for start, patch, batch in stages]
+        self.build = build
+        self.unit = unit
+        self.name = name
+        self._stage = None
+        self._bundle = None
+
+    @property
+    def sizes(self):
+        return sorted(set(patch for _, patch, _ in self.stages))
+
+    def stage(self, epoch, step):
+        t = epoch if self.unit == 'epoch' else step
+        current = self.stages[0]
+        for s in self.stages:
+            if s[0] <= t:
+                current = s
+        return current[1], current[2]
+
+    def _enter(self, stage):
+        if stage != self._stage:
+            if self._stage is not None:
+                print("[*] %s curriculum: HR crops %d -> %d, batch size %d -> %d" % (self.name, self._stage[0], stage[0], self._stage[1], stage[1]))
+            self._stage = stage
+            self._bundle = self.build(*stage)
+        return self._bundle
+
+    def epoch(self, epoch, step, n_images):
+        """Yields (bundle, lr, hr) for one epoch starting at phase step `step`, `bundle` being what `build` returned.
+
+        An epoch is one pass over the dataset. When a step-based stage change falls inside it, the data is
+        rebuilt and the epoch goes on until `n_images` images have been drawn, so epoch-based LR decay is unaffected.
+        """
+        seen, switched = 0, False
+        while True:
+            stage = self.stage(epoch, step)
+            bundle = self._enter(stage)
+            for lr, hr in bundle[0]:
+                yield bundle, lr, hr
+                step += 1
+                seen += int(hr.shape[0])
+                if switched and seen >= n_images:
+                    return
+                if self.stage(epoch, step) != stage:
+                    if seen >= n_images:
+                        return  # the change falls on the epoch boundary, the next epoch starts in the new stage
+                    switched = True
+                    break
+            else:
+                if not switched or seen >= n_images:
+                    return
+
+
+class DStepScheduler(object):
+    """Decides how many D updates follow each G update of the adversarial phase.
+
+    'fixed' runs `n_critic` D steps per G step; fractions are accumulated, so 0.5 runs D after every second G
+    step. 'adaptive' starts from the same count and follows the EMA (`ema`) of d_loss and of D's accuracy on the
+    real and generated batch: D is skipped while it separates them easily (accuracy >= `acc_high` or d_loss <=
+    `loss_low`), at most `max_skip` G steps in a row so its statistics stay fresh, and gets one extra step, up to
+    `max_steps`, while it falls behind (accuracy <= `acc_low`). Savings are counted against one D step per G step.
+    """
+
+    def __init__(self, policy='fixed', n_critic=1, ema=0.9, acc_high=0.95, acc_low=0.6, loss_low=0.1, max_skip=8, max_steps=3):
+        if policy not in ('fixed', 'adaptive'):
+            raise ValueError("unknown D schedule %s, use fixed or adaptive" % policy)
+        if n_critic <= 0:
+            raise ValueError("n_critic must be positive, got %s" % n_critic)
+        self.policy = policy
+        self.n_critic = n_critic
+        self.ema = ema
+        self.acc_high, self.acc_low, self.loss_low = acc_high, acc_low, loss_low
+        self.max_skip, self.max_steps = max_skip, max_steps
+        self.d_loss = self.accuracy = None
+        self.last_loss = float('nan')
+        self.d_step_time = None
+        self._credit = max(0., 1. - n_critic)  # the first G step is always followed by a D step
+        self._skipped = 0
+        self.g_steps = self.d_steps = 0
+        self._epoch = (0, 0)
+
+    def n_steps(self):
+        self._credit += self.n_critic
+        n = int(self._credit)
+        self._credit -= n
+        if self.policy == 'adaptive' and self.d_loss is not None:
+            if self.accuracy is not None and self.accuracy <= self.acc_low:
+                n = min(max(n, 1) + 1, self.max_steps)
+            elif (self.accuracy is not None and self.accuracy >= self.acc_high) or self.d_loss <= self.loss_low:
+                n = 0 if self._skipped < self.max_skip else max(n, 1)
+        self._skipped = self._skipped + 1 if n == 0 else 0
+        return n
+
+    def _update(self, value, new):
+        return new if value is None else self.ema * value + (1 - self.ema) * new
+
+    def run(self, train_d, lr, hr, accuracy=None):
+        """Runs the D updates of one G step with `train_d` and returns the most recent d_loss.
+
+        `accuracy` returns D's accuracy on the batch of its last step, e.g. `WithLoss_D.last_accuracy`.
+        """
+        n = self.n_steps()
+        for _ in range(n):
+            start = time.perf_counter()
+            self.last_loss = float(train_d(lr, hr))
+            self.d_step_time = self._update(self.d_step_time, time.perf_counter() - start)
+            self.d_loss = self._update(self.d_loss, self.last_loss)
+            if accuracy is not None:
+                self.accuracy = self._update(self.accuracy, float(accuracy()))
+        self.g_steps += 1
+        self.d_steps += n
+        return self.last_loss
+
+    def report(self):
+        """Prints the D steps run since the last report and in total, and the D time saved against 1:1."""
+        g_steps, d_steps = self.g_steps - self._epoch[0], self.d_steps - self._epoch[1]
+        self._epoch = (self.g_steps, self.d_steps)
+        step_time = self.d_step_time or 0.
+        print("[*] D schedule (%s): %d D steps for %d G steps, %d saved vs 1:1 (%.1fs), total %d saved (%.1fs), d_loss %.3f, accuracy %s" % (
+            self.policy, d_steps, g_steps, g_steps - d_steps, (g_steps - d_steps) * step_time, self.g_steps - self.d_steps,
+            (self.g_steps - self.d_steps) * step_time, self.d_loss if self.d_loss is not None else float('nan'),
+            '%.3f' % self.accuracy if self.accuracy is not None else '-'))
@@ -0,0 +1,245 @@
+"""Compressed patch shards: the patches of an .npy array stored as PNG, lossless WebP or zstd blobs.
+
+    python shards.py --patches /gdrive/MyDrive/Synla_4096.npy --output shards/Synla_4096 --codec png --n_shards 8
+    python shards.py --bench --patches /gdrive/MyDrive/Synla_4096.npy --shards 'shards/Synla_4096-*.shard'
+
+A shard file is the blobs back to back, followed by an index of (offset, length) uint64 pairs, a JSON header
+(codec, patch shape, dtype, count) and a fixed 24-byte footer (index offset, header length, magic). Readers
+fetch one blob with a single pread, so patches can be read and decoded from any number of threads or
+processes. Set config.TRAIN.patches / config.VALID.patches to the shard glob to train from shards; zstd needs
+the `zstandard` package.
+"""
+import glob
+import json
+import os
+import struct
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from chunk_cache import CachedNpyArray
+
+MAGIC = b'SRSHARD1'
+FOOTER = struct.Struct('<QQ8s')
+CODECS = ('png', 'webp', 'zstd')
+_live_readers = weakref.WeakSet()
+
+
+def _after_fork():
+    # a forked loader worker inherits the parent's reader locks, possibly held by one of its threads
+    for reader in list(_live_readers):
+        reader._lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd shards need the zstandard package (pip install zstandard), or use --codec png / webp")
+    return zstandard
+
+
+def encode(img, codec, level=3):
+    if codec == 'zstd':
+        return _zstandard().ZstdCompressor(level=level).compress(np.ascontiguousarray(img).tobytes())
+    if codec == 'png':
+        ok, buf = cv2.imencode('.png', np.ascontiguousarray(img[..., ::-1]), [cv2.IMWRITE_PNG_COMPRESSION, level])
+    elif codec == 'webp':
+        ok, buf = cv2.imencode('.webp', np.ascontiguousarray(img[..., ::-1]), [cv2.IMWRITE_WEBP_QUALITY, 101])  # above 100 is lossless
+    else:
+        raise ValueError("unknown codec %s, use one of %s" % (codec, ', '.join(CODECS)))
+    if not ok:
+        raise IOError("%s encoding failed" % codec)
+    return buf.tobytes()
+
+
+def decode(blob, codec, shape, dtype):
+    if codec == 'zstd':
+        return np.frombuffer(_zstandard().ZstdDecompressor().decompress(blob), dtype=dtype).reshape(shape)
+    img = cv2.imdecode(np.frombuffer(blob, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise IOError("corrupt %s blob" % codec)
+    return np.ascontiguousarray(img[..., ::-1])
+
+
+def write_shards(patches_path, output, codec='png', n_shards=8, level=3, workers=8):
+    """Writes the patches of `patches_path` into `n_shards` files named <output>-<i>-of-<n>.shard."""
+    patches = np.load(patches_path, mmap_mode='r')
+    n = len(patches)
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    raw, written = 0, 0
+    with ThreadPoolExecutor(workers) as pool:
+        for s in range(n_shards):
+            lo, hi = s * n // n_shards, (s + 1) * n // n_shards
+            path = '%s-%05d-of-%05d.shard' % (output, s, n_shards)
+            index = np.empty((hi - lo, 2), dtype=np.uint64)
+            with open(path + '.tmp', 'wb') as f:
+                for j, blob in enumerate(pool.map(lambda i: encode(patches[i], codec, level), range(lo, hi))):
+                    index[j] = (f.tell(), len(blob))
+                    f.write(blob)
+                index_offset = f.tell()
+                f.write(index.tobytes())
+                header = json.dumps({'codec': codec, 'shape': list(patches.shape[1:]), 'dtype': patches.dtype.str, 'count': hi - lo}).encode()
+                f.write(header)
+                f.write(FOOTER.pack(index_offset, len(header), MAGIC))
+                written += f.tell()
+            os.replace(path + '.tmp', path)
+            raw += (hi - lo) * patches[0].nbytes
+            print("[*] %s: %d patches" % (path, hi - lo))
+    print("[*] %d patches, %.1fMB raw, %.1fMB in shards (%.2fx)" % (n, raw / 2**20, written / 2**20, raw / max(written, 1)))
+
+
+class ShardReader(object):
+    """Random access to the patches of one shard file. The file descriptor is opened lazily, per process.
+
+    Safe to read from several threads: the open and the `bytes_read` counter are guarded by a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.bytes_read = 0
+        self._fd = None
+        self._lock = threading.Lock()
+        _live_readers.add(self)
+        with open(path, 'rb') as f:
+            footer_start = f.seek(-FOOTER.size, os.SEEK_END)
+            index_offset, header_len, magic = FOOTER.unpack(f.read(FOOTER.size))
+            if magic != MAGIC:
+                raise IOError("%s is not a patch shard" % path)
+            f.seek(index_offset)
+            index = f.read(footer_start - header_len - index_offset)
+            header = json.loads(f.read(header_len).decode())
+        self.index = np.frombuffer(index, dtype=np.uint64).reshape(-1, 2)
+        self.codec = header['codec']
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        _live_readers.add(self)
+
+    def __len__(self):
+        return len(self.index)
+
+    def read(self, i):
+        fd = self._fd
+        if fd is None:
+            with self._lock:
+                if self._fd is None:
+                    self._fd = os.open(self.path, os.O_RDONLY)
+                fd = self._fd
+        offset, length = (int(v) for v in self.index[i])
+        blob = os.pread(fd, length, offset)
+        with self._lock:
+            self.bytes_read += length
+        return blob
+
+    def __getitem__(self, i):
+        return decode(self.read(i), self.codec, self.shape, self.dtype)
+
+
+class ShardedPatches(object):
+    """The patches of all shards matching `pattern`, indexed like the (N, H, W, C) array they were written from."""
+
+    def __init__(self, pattern):
+        paths = sorted(glob.glob(pattern))
+        if not paths:
+            raise IOError("no shards match %s" % pattern)
+        self.shards = [ShardReader(p) for p in paths]
+        self.shape = (sum(len(s) for s in self.shards),) + self.shards[0].shape
+        self.dtype = self.shards[0].dtype
+        self._starts = np.cumsum([0] + [len(s) for s in self.shards])
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def bytes_read(self):
+        return sum(s.bytes_read for s in self.shards)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return np.stack([self[j] for j in range(*i.indices(len(self)))])
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        s = int(np.searchsorted(self._starts, i, side='right')) - 1
+        return self.shards[s][i - int(self._starts[s])]
+
+
+def is_sharded(path):
+    return path.endswith('.shard') or glob.has_magic(path)
+
+
+def open_patches(path, cache=None):
+    """A memory-mapped .npy array or the ShardedPatches of a shard glob; both index as (N, H, W, C) uint8.
+
+    With a `chunk_cache.ChunkCache`, an .npy array is read through the local chunk cache instead of mapped.
+    """
+    if is_sharded(path):
+        return ShardedPatches(path)
+    if cache is not None:
+        return CachedNpyArray(path, cache)
+    return np.load(path, mmap_mode='r')
+
+
+def bench(patches_path, pattern, workers=8, n=None):
+    """Reads (and for shards decodes) every patch once with `workers` threads, like one epoch of the data pipeline.
+
+    Only timings taken with a cold page cache (a fresh mount, or after dropping caches) reflect the network drive.
+    """
+    raw = np.load(patches_path, mmap_mode='r')
+    shards = ShardedPatches(pattern)
+    n = min(n or len(raw), len(raw), len(shards))
+    rows = []
+    with ThreadPoolExecutor(workers) as pool:
+        start = time.perf_counter()
+        for _ in pool.map(lambda i: np.array(raw[i]), range(n)):
+            pass
+        rows.append(('raw memmap', n * raw[0].nbytes, time.perf_counter() - start))
+        start = time.perf_counter()
+        for _ in pool.map(lambda i: shards[i], range(n)):
+            pass
+        rows.append(('shards (%s)' % shards.shards[0].codec, shards.bytes_read, time.perf_counter() - start))
+    print("%-18s %12s %10s %14s %10s" % ("source", "MB read", "epoch s", "patches/sec", "MB/sec"))
+    for name, nbytes, elapsed in rows:
+        print("%-18s %12.1f %10.2f %14.1f %10.1f" % (name, nbytes / 2**20, elapsed, n / elapsed, nbytes / 2**20 / elapsed))
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--patches', type=str, required=True, help='.npy array of patches')
+    parser.add_argument('--output', type=str, default=None, help='shard path prefix')
+    parser.add_argument('--codec', type=str, default='png', help=', '.join(CODECS))
+    parser.add_argument('--level', type=int, default=3, help='PNG or zstd compression level')
+    parser.add_argument('--n_shards', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=8, help='encode / read threads')
+    parser.add_argument('--bench', action='store_true', help='compare one epoch of reads against --shards')
+    parser.add_argument('--shards', type=str, default=None, help='shard glob for --bench')
+    parser.add_argument('--n', type=int, default=None, help='patches read by --bench, all by default')
+    args = parser.parse_args()
+
+    if args.bench:
+        bench(args.patches, args.shards, args.workers, args.n)
+    else:
+        write_shards(args.patches, args.output, args.codec, args.n_shards, args.level, args.workers)
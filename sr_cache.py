@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from inference import to_uint8
+from model_holder import mmap_npz, weights_digest
+
+
+class SRCache(object):
+    """On-disk cache of super-resolved uint8 outputs with LRU eviction.
+
+    Entries are keyed by a hash of the input pixels, the generator weights and the inference settings, so a
+    retrained `g.npz` or a different tile size never returns stale results. The weights are identified by the
+    `model_holder.weights_digest` of `weights_path`, or, when a ModelHolder serves the generator (`weights_path`
+    None), by the `weights_id` of the instance that computed the outputs, passed to `key`. Recency is tracked with the
+    file mtime, which makes the LRU order survive restarts. Several processes may share a directory, each only
+    accounts for the entries it saw at start-up or wrote itself.
+    """
+
+    def __init__(self, root, weights_path, settings, max_bytes=2 * 1024**3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self.settings = settings
+        os.makedirs(root, exist_ok=True)
+        self._prefixes = {}
+        self.weights_id = weights_digest(mmap_npz(weights_path)) if weights_path is not None else None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        for path in sorted((os.path.join(root, n) for n in os.listdir(root) if n.endswith('.npy')), key=os.path.getmtime):
+            self._entries[path] = os.path.getsize(path)
+            self._bytes += self._entries[path]
+
+    def _prefix(self, weights_id):
+        if weights_id not in self._prefixes:
+            self._prefixes[weights_id] = hashlib.sha256((weights_id + json.dumps(self.settings, sort_keys=True)).encode()).digest()
+        return self._prefixes[weights_id]
+
+    def key(self, img, weights_id=None):
+        weights_id = weights_id or self.weights_id
+        if weights_id is None:
+            raise ValueError("the cache has no weights file, pass the weights_id of the generator that runs the request")
+        img = np.ascontiguousarray(img)
+        h = hashlib.sha256(self._prefix(weights_id))
+        h.update(("%s%s" % (img.shape, img.dtype)).encode())
+        h.update(img.data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key + '.npy')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            out = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        if path in self._entries:
+            self._entries.move_to_end(path)
+        return out
+
+    def put(self, key, out):
+        path = self._path(key)
+        tmp = path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.save(f, out)
+        os.replace(tmp, path)
+        self._bytes += os.path.getsize(path) - self._entries.pop(path, 0)
+        self._entries[path] = os.path.getsize(path)
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            old, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+        }
+
+    def report(self):
+        m = self.metrics()
+        print("[*] cache hits: %d misses: %d (%.1f%%) evictions: %d entries: %d size: %.1fMB" % (
+            m['hits'], m['misses'], 100 * m['hit_rate'], m['evictions'], m['entries'], m['bytes'] / 2**20))
+
+
+def cached_upscale(cache, imgs, upscale_fn, weights_id=None):
+    """Returns uint8 outputs for a list of float images, running `upscale_fn` only on the cache misses.
+
+    `weights_id` identifies the weights `upscale_fn` runs on, see `SRCache.key`.
+    """
+    if cache is None:
+        return [to_uint8(out) for out in upscale_fn(imgs)]
+    keys = [cache.key(img, weights_id) for img in imgs]
+    outs = [cache.get(k) for k in keys]
+    todo = [i for i, out in enumerate(outs) if out is None]
+    if todo:
+        for i, out in zip(todo, upscale_fn([imgs[i] for i in todo])):
+            outs[i] = to_uint8(out)
+            cache.put(keys[i], outs[i])
+    return outs
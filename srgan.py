@@ -10,18 +10,18 @@ data_format = 'channels_last'
 
 class ResidualBlock(Module):
 
-    def __init__(self):
+    def __init__(self, channels=64):
         super(ResidualBlock, self).__init__()
         self.conv1 = Conv2d(
-            out_channels=64, kernel_size=(3, 3), stride=(1, 1), act=None, padding='SAME', W_init=W_init,
+            out_channels=channels, kernel_size=(3, 3), stride=(1, 1), act=None, padding='SAME', W_init=W_init,
             data_format=data_format, b_init=None
         )
-        self.bn1 = BatchNorm2d(num_features=64, act=tlx.ReLU, gamma_init=G_init, data_format=data_format)
+        self.bn1 = BatchNorm2d(num_features=channels, act=tlx.ReLU, gamma_init=G_init, data_format=data_format)
         self.conv2 = Conv2d(
-            out_channels=64, kernel_size=(3, 3), stride=(1, 1), act=None, padding='SAME', W_init=W_init,
+            out_channels=channels, kernel_size=(3, 3), stride=(1, 1), act=None, padding='SAME', W_init=W_init,
             data_format=data_format, b_init=None
         )
-        self.bn2 = BatchNorm2d(num_features=64, act=None, gamma_init=G_init, data_format=data_format)
+        self.bn2 = BatchNorm2d(num_features=channels, act=None, gamma_init=G_init, data_format=data_format)
 
     def forward(self, x):
         z = self.conv1(x)
@@ -35,36 +35,41 @@ class ResidualBlock(Module):
 class SRGAN_g(Module):
     """ Generator in Photo-Realistic Single Image Super-Resolution Using a Generative Adversarial Network
     feature maps (n) and stride (s) feature maps (n) and stride (s)
+
+    n_blocks residual blocks of n_channels feature maps, the defaults are the paper's 16 x 64.
+    Smaller values give the compact students trained by `--mode distill`.
     """
 
-    def __init__(self):
+    def __init__(self, n_blocks=16, n_channels=64):
         super(SRGAN_g, self).__init__()
         self.conv1 = Conv2d(
-            out_channels=64, kernel_size=(3, 3), stride=(1, 1), act=tlx.ReLU, padding='SAME', W_init=W_init,
+            out_channels=n_channels, kernel_size=(3, 3), stride=(1, 1), act=tlx.ReLU, padding='SAME', W_init=W_init,
             data_format=data_format
         )
-        self.residual_block = self.make_layer()
+        self.residual_block = self.make_layer(n_blocks, n_channels)
         self.conv2 = Conv2d(
-            out_channels=64, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init,
+            out_channels=n_channels, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init,
             data_format=data_format, b_init=None
         )
-        self.bn1 = BatchNorm2d(num_features=64, act=None, gamma_init=G_init, data_format=data_format)
-        self.conv3 = Conv2d(out_channels=256, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init, data_format=data_format)#256
+        self.bn1 = BatchNorm2d(num_features=n_channels, act=None, gamma_init=G_init, data_format=data_format)
+        self.conv3 = Conv2d(out_channels=n_channels * 4, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init, data_format=data_format)#256
         self.subpiexlconv1 = SubpixelConv2d(data_format=data_format, scale=2, act=tlx.ReLU)
-        self.conv4 = Conv2d(out_channels=256, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init, data_format=data_format)#256
+        self.conv4 = Conv2d(out_channels=n_channels * 4, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init, data_format=data_format)#256
         self.subpiexlconv2 = SubpixelConv2d(data_format=data_format, scale=2, act=tlx.ReLU)
         self.conv5 = Conv2d(3, kernel_size=(1, 1), stride=(1, 1), act=tlx.Tanh, padding='SAME', W_init=W_init, data_format=data_format)
 
-    def make_layer(self):
+    def make_layer(self, n_blocks=16, channels=64):
         layer_list = []
-        for i in range(16):
-            layer_list.append(ResidualBlock())
+        for i in range(n_blocks):
+            layer_list.append(ResidualBlock(channels))
         return Sequential(layer_list)
 
-    def forward(self, x):
+    def trunk(self, x):
+        """conv1 and the residual blocks, returns the residual features and the conv1 skip connection."""
         x = self.conv1(x)
-        temp = x
-        x = self.residual_block(x)
+        return self.residual_block(x), x
+
+    def tail(self, x, temp):
         x = self.conv2(x)
         x = self.bn1(x)
         x = x + temp
@@ -73,9 +78,111 @@ class SRGAN_g(Module):
         x = self.conv4(x)
         x = self.subpiexlconv2(x)
         x = self.conv5(x)
-
         return x
 
+    def tail_weights(self):
+        """Trainable weights of conv2 / bn1 and the upsampling convs, the part trained by `--mode finetune`."""
+        return [w for layer in (self.conv2, self.bn1, self.conv3, self.conv4, self.conv5) for w in layer.trainable_weights]
+
+    def forward(self, x):
+        x, temp = self.trunk(x)
+        return self.tail(x, temp)
+
+
+class UpsampleHead(Module):
+    """Conv + subpixel stages taking the fused trunk features to `scale` times the resolution, then the RGB conv.
+
+    x2 and x3 use one subpixel stage, x4 two x2 stages like SRGAN_g. `in_channels` is given to every conv so all
+    heads have their weights as soon as they are created, not only the one that init_build happens to run.
+    """
+
+    def __init__(self, scale, n_channels=64):
+        super(UpsampleHead, self).__init__()
+        if scale not in (2, 3, 4):
+            raise ValueError("unsupported scale %s, use 2, 3 or 4" % scale)
+        layers = []
+        for r in ([2, 2] if scale == 4 else [scale]):
+            layers.append(
+                Conv2d(
+                    out_channels=n_channels * r * r, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init,
+                    data_format=data_format, in_channels=n_channels
+                )
+            )
+            layers.append(SubpixelConv2d(data_format=data_format, scale=r, act=tlx.ReLU))
+        layers.append(
+            Conv2d(3, kernel_size=(1, 1), stride=(1, 1), act=tlx.Tanh, padding='SAME', W_init=W_init, data_format=data_format, in_channels=n_channels)
+        )
+        self.layers = Sequential(layers)
+
+    def forward(self, x):
+        return self.layers(x)
+
+
+class SRGAN_g_multiscale(Module):
+    """SRGAN_g with one conv1 + residual trunk shared by upsampling heads for several scales.
+
+    forward(x, scale) runs the trunk once and the head of `scale`, so one set of trunk weights serves every
+    scale in `scales`. Heads are stored as head_x2, head_x3, head_x4.
+    """
+
+    def __init__(self, n_blocks=16, n_channels=64, scales=(2, 3, 4)):
+        super(SRGAN_g_multiscale, self).__init__()
+        self.scales = tuple(scales)
+        self.conv1 = Conv2d(
+            out_channels=n_channels, kernel_size=(3, 3), stride=(1, 1), act=tlx.ReLU, padding='SAME', W_init=W_init,
+            data_format=data_format
+        )
+        self.residual_block = Sequential([ResidualBlock(n_channels) for _ in range(n_blocks)])
+        self.conv2 = Conv2d(
+            out_channels=n_channels, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init,
+            data_format=data_format, b_init=None
+        )
+        self.bn1 = BatchNorm2d(num_features=n_channels, act=None, gamma_init=G_init, data_format=data_format)
+        for scale in self.scales:
+            setattr(self, 'head_x%d' % scale, UpsampleHead(scale, n_channels))
+
+    def head(self, scale):
+        if scale not in self.scales:
+            raise ValueError("scale %s not in %s" % (scale, self.scales))
+        return getattr(self, 'head_x%d' % scale)
+
+    def scale_weights(self, scale):
+        """Trainable weights used at `scale`: the shared trunk plus that scale's head."""
+        others = set(id(w) for s in self.scales if s != scale for w in self.head(s).trainable_weights)
+        return [w for w in self.trainable_weights if id(w) not in others]
+
+    def forward(self, x, scale=4):
+        x = self.conv1(x)
+        temp = x
+        x = self.residual_block(x)
+        x = self.conv2(x)
+        x = self.bn1(x)
+        x = x + temp
+        return self.head(scale)(x)
+
+
+class AtScale(Module):
+    """Presents SRGAN_g_multiscale at a fixed scale as a one-input generator, for code written against SRGAN_g."""
+
+    def __init__(self, G, scale):
+        super(AtScale, self).__init__()
+        self.G = G
+        self.scale = scale
+
+    def forward(self, x):
+        return self.G(x, self.scale)
+
+
+class TailOf(Module):
+    """Presents the tail of an SRGAN_g as a one-input generator taking the (features, skip) pair of `SRGAN_g.trunk`."""
+
+    def __init__(self, G):
+        super(TailOf, self).__init__()
+        self.G = G
+
+    def forward(self, x):
+        return self.G.tail(*x)
+
 
 class SRGAN_g2(Module):
     """ Generator in Photo-Realistic Single Image Super-Resolution Using a Generative Adversarial Network
@@ -86,27 +193,27 @@ class SRGAN_g2(Module):
     Use Resize Conv
     """
 
-    def __init__(self):
+    def __init__(self, n_blocks=16, n_channels=64):
         super(SRGAN_g2, self).__init__()
         self.conv1 = Conv2d(
-            out_channels=64, kernel_size=(3, 3), stride=(1, 1), act=None, padding='SAME', W_init=W_init,
+            out_channels=n_channels, kernel_size=(3, 3), stride=(1, 1), act=None, padding='SAME', W_init=W_init,
             data_format=data_format
         )
-        self.residual_block = self.make_layer()
+        self.residual_block = self.make_layer(n_blocks, n_channels)
         self.conv2 = Conv2d(
-            out_channels=64, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init,
+            out_channels=n_channels, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init,
             data_format=data_format, b_init=None
         )
         self.bn1 = BatchNorm2d(act=None, gamma_init=G_init, data_format=data_format)
         self.upsample1 = UpSampling2d(data_format=data_format, scale=(2, 2), method='bilinear')
         self.conv3 = Conv2d(
-            out_channels=64, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init,
+            out_channels=n_channels, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init,
             data_format=data_format, b_init=None
         )
         self.bn2 = BatchNorm2d(act=tlx.ReLU, gamma_init=G_init, data_format=data_format)
         self.upsample2 = UpSampling2d(data_format=data_format, scale=(4, 4), method='bilinear')
         self.conv4 = Conv2d(
-            out_channels=32, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init,
+            out_channels=n_channels // 2, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init,
             data_format=data_format, b_init=None
         )
         self.bn3 = BatchNorm2d(act=tlx.ReLU, gamma_init=G_init, data_format=data_format)
@@ -114,10 +221,10 @@ class SRGAN_g2(Module):
             out_channels=3, kernel_size=(1, 1), stride=(1, 1), act=tlx.Tanh, padding='SAME', W_init=W_init
         )
 
-    def make_layer(self):
+    def make_layer(self, n_blocks=16, channels=64):
         layer_list = []
-        for i in range(16):
-            layer_list.append(ResidualBlock())
+        for i in range(n_blocks):
+            layer_list.append(ResidualBlock(channels))
         return Sequential(layer_list)
 
     def forward(self, x):
@@ -212,92 +319,62 @@ class SRGAN_d2(Module):
 
 
 class SRGAN_d(Module):
+    """ Discriminator
+
+    n_layers stride-2 4x4 convs double the width from dim up to dim * 2 ** (n_layers - 1) (six layers up to
+    2048 channels by default), followed by the 1x1 / 3x3 residual bottleneck. The default architecture builds
+    the same layers in the same order as before, so existing d.npz checkpoints still load.
+    With patch=True the Flatten / Linear head is replaced by a 3x3 conv giving one logit per location,
+    which makes the discriminator fully convolutional and independent of the patch size.
+    """
 
-    def __init__(self, dim=64):
+    def __init__(self, dim=64, n_layers=6, patch=False):
         super(SRGAN_d, self).__init__()
+        self.n_layers = n_layers
+        self.patch = patch
         self.conv1 = Conv2d(
             out_channels=dim, kernel_size=(4, 4), stride=(2, 2), act=tlx.LeakyReLU, padding='SAME', W_init=W_init,
             data_format=data_format
         )
-        self.conv2 = Conv2d(
-            out_channels=dim * 2, kernel_size=(4, 4), stride=(2, 2), act=None, padding='SAME', W_init=W_init,
-            data_format=data_format, b_init=None
-        )
-        self.bn1 = BatchNorm2d(num_features=dim * 2, act=tlx.LeakyReLU, gamma_init=G_init, data_format=data_format)
-        self.conv3 = Conv2d(
-            out_channels=dim * 4, kernel_size=(4, 4), stride=(2, 2), act=None, padding='SAME', W_init=W_init,
-            data_format=data_format, b_init=None
-        )
-        self.bn2 = BatchNorm2d(num_features=dim * 4, act=tlx.LeakyReLU, gamma_init=G_init, data_format=data_format)
-        self.conv4 = Conv2d(
-            out_channels=dim * 8, kernel_size=(4, 4), stride=(2, 2), act=None, padding='SAME', W_init=W_init,
-            data_format=data_format, b_init=None
-        )
-        self.bn3 = BatchNorm2d(num_features=dim * 8, act=tlx.LeakyReLU, gamma_init=G_init, data_format=data_format)
-        self.conv5 = Conv2d(
-            out_channels=dim * 16, kernel_size=(4, 4), stride=(2, 2), act=None, padding='SAME', W_init=W_init,
-            data_format=data_format, b_init=None
-        )
-        self.bn4 = BatchNorm2d(num_features=dim * 16, act=tlx.LeakyReLU, gamma_init=G_init, data_format=data_format)
-        self.conv6 = Conv2d(
-            out_channels=dim * 32, kernel_size=(4, 4), stride=(2, 2), act=None, padding='SAME', W_init=W_init,
-            data_format=data_format, b_init=None
-        )
-        self.bn5 = BatchNorm2d(num_features=dim * 32, act=tlx.LeakyReLU, gamma_init=G_init, data_format=data_format)
-        self.conv7 = Conv2d(
-            out_channels=dim * 16, kernel_size=(1, 1), stride=(1, 1), act=None, padding='SAME', W_init=W_init,
-            data_format=data_format, b_init=None
-        )
-        self.bn6 = BatchNorm2d(num_features=dim * 16, act=tlx.LeakyReLU, gamma_init=G_init, data_format=data_format)
-        self.conv8 = Conv2d(
-            out_channels=dim * 8, kernel_size=(1, 1), stride=(1, 1), act=None, padding='SAME', W_init=W_init,
-            data_format=data_format, b_init=None
-        )
-        self.bn7 = BatchNorm2d(num_features=dim * 8, act=None, gamma_init=G_init, data_format=data_format)
-        self.conv9 = Conv2d(
-            out_channels=dim * 2, kernel_size=(1, 1), stride=(1, 1), act=None, padding='SAME', W_init=W_init,
-            data_format=data_format, b_init=None
-        )
-        self.bn8 = BatchNorm2d(num_features=dim * 2, act=tlx.LeakyReLU, gamma_init=G_init, data_format=data_format)
-        self.conv10 = Conv2d(
-            out_channels=dim * 2, kernel_size=(3, 3), stride=(1, 1), act=None, padding='SAME', W_init=W_init,
-            data_format=data_format, b_init=None
-        )
-        self.bn9 = BatchNorm2d(num_features=dim * 2, act=tlx.LeakyReLU, gamma_init=G_init, data_format=data_format)
-        self.conv11 = Conv2d(
-            out_channels=dim * 8, kernel_size=(3, 3), stride=(1, 1), act=None, padding='SAME', W_init=W_init,
-            data_format=data_format, b_init=None
-        )
-        self.bn10 = BatchNorm2d(num_features=dim * 8, gamma_init=G_init, data_format=data_format)
+        for i in range(1, n_layers):
+            setattr(self, 'conv%d' % (i + 1), Conv2d(
+                out_channels=dim * 2 ** i, kernel_size=(4, 4), stride=(2, 2), act=None, padding='SAME', W_init=W_init,
+                data_format=data_format, b_init=None
+            ))
+            setattr(self, 'bn%d' % i, BatchNorm2d(num_features=dim * 2 ** i, act=tlx.LeakyReLU, gamma_init=G_init, data_format=data_format))
+        top = dim * 2 ** (n_layers - 1)
+        # (out_channels, kernel, act) of the bottleneck convs, the last one is added back to the output of the second
+        bottleneck = [(top // 2, 1, tlx.LeakyReLU), (top // 4, 1, None), (dim * 2, 1, tlx.LeakyReLU), (dim * 2, 3, tlx.LeakyReLU), (top // 4, 3, None)]
+        for j, (channels, k, act) in enumerate(bottleneck):
+            setattr(self, 'conv%d' % (n_layers + j + 1), Conv2d(
+                out_channels=channels, kernel_size=(k, k), stride=(1, 1), act=None, padding='SAME', W_init=W_init,
+                data_format=data_format, b_init=None
+            ))
+            setattr(self, 'bn%d' % (n_layers + j), BatchNorm2d(num_features=channels, act=act, gamma_init=G_init, data_format=data_format))
         self.add = Elementwise(combine_fn=tlx.add, act=tlx.LeakyReLU)
-        self.flat = Flatten()
-        self.dense = Linear(out_features=1, W_init=W_init)
+        if patch:
+            self.conv_out = Conv2d(
+                out_channels=1, kernel_size=(3, 3), stride=(1, 1), padding='SAME', W_init=W_init, data_format=data_format
+            )
+        else:
+            self.flat = Flatten()
+            self.dense = Linear(out_features=1, W_init=W_init)
+
+    def _conv_bn(self, x, i):
+        x = getattr(self, 'conv%d' % (i + 1))(x)
+        return getattr(self, 'bn%d' % i)(x)
 
     def forward(self, x):
 
         x = self.conv1(x)
-        x = self.conv2(x)
-        x = self.bn1(x)
-        x = self.conv3(x)
-        x = self.bn2(x)
-        x = self.conv4(x)
-        x = self.bn3(x)
-        x = self.conv5(x)
-        x = self.bn4(x)
-        x = self.conv6(x)
-        x = self.bn5(x)
-        x = self.conv7(x)
-        x = self.bn6(x)
-        x = self.conv8(x)
-        x = self.bn7(x)
+        for i in range(1, self.n_layers + 2):
+            x = self._conv_bn(x, i)
         temp = x
-        x = self.conv9(x)
-        x = self.bn8(x)
-        x = self.conv10(x)
-        x = self.bn9(x)
-        x = self.conv11(x)
-        x = self.bn10(x)
+        for i in range(self.n_layers + 2, self.n_layers + 5):
+            x = self._conv_bn(x, i)
         x = self.add([temp, x])
+        if self.patch:
+            return self.conv_out(x)
         x = self.flat(x)
         x = self.dense(x)
 
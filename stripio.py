@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from inference import adaptive_upscale, tiled_upscale, to_uint8
+
+
+def _ext(path):
+    return os.path.splitext(path)[1].lower()
+
+
+def open_input(path):
+    """Opens an HWC uint8 image so that row strips can be read without decoding the whole file.
+
+    .npy files and uncompressed TIFFs are memory-mapped, compressed TIFFs are read strip by strip through zarr.
+    Other formats are decoded once by PIL, which still keeps the 4x output out of memory.
+    """
+    ext = _ext(path)
+    if ext == '.npy':
+        return np.load(path, mmap_mode='r')
+    if ext in ('.tif', '.tiff'):
+        import tifffile
+        try:
+            return tifffile.memmap(path, mode='r')
+        except ValueError:
+            # compressed or non contiguous, fall back to chunked reads
+            import zarr
+            return zarr.open(tifffile.imread(path, aszarr=True), mode='r')
+    Image.MAX_IMAGE_PIXELS = None
+    return np.asarray(Image.open(path).convert('RGB'))
+
+
+def open_output(path, shape):
+    """Creates a memory-mapped uint8 array of `shape` backed by `path` (.npy or BigTIFF)."""
+    ext = _ext(path)
+    if ext == '.npy':
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+    if ext in ('.tif', '.tiff'):
+        import tifffile
+        return tifffile.memmap(path, shape=shape, dtype=np.uint8, photometric='rgb', bigtiff=True)
+    raise ValueError("unsupported output format %s, use .npy or .tif" % ext)
+
+
+def _as_rgb(strip):
+    strip = np.asarray(strip)
+    if strip.ndim == 2:
+        strip = strip[..., np.newaxis]
+    if strip.shape[2] == 1:
+        strip = np.repeat(strip, 3, axis=2)
+    return strip[..., :3]
+
+
+def upscale_strips(G, src, dst, strip_rows=448, tile=128, overlap=8, batch_size=8, scale=4, threshold=None):
+    """Super-resolves `src` into `dst` one row strip at a time.
+
+    Each strip is read with `overlap` extra rows above and below so that strip borders see the same context
+    as tile borders, and its output rows are converted to uint8 and written straight into the memory-mapped
+    output. Peak memory is bounded by a few strips instead of the whole 4x image.
+    With a `threshold`, flat tiles are interpolated instead of generated (see `adaptive_upscale`).
+    """
+    img = open_input(src)
+    h, w = img.shape[:2]
+    out = open_output(dst, (h * scale, w * scale, 3))
+    n_skipped = n_tiles = 0
+    for y0 in range(0, h, strip_rows):
+        y1 = min(y0 + strip_rows, h)
+        top, bottom = max(0, y0 - overlap), min(h, y1 + overlap)
+        strip = _as_rgb(img[top:bottom]).astype(np.float32) / 255.
+        if threshold is None:
+            sr = tiled_upscale(G, strip, tile, overlap, batch_size, scale)
+        else:
+            # counts, not per-strip fractions, so a short last strip weighs by its tiles
+            sr, skipped, tiles = adaptive_upscale(G, strip, threshold, tile, overlap, batch_size, scale)
+            n_skipped += skipped
+            n_tiles += tiles
+        out[y0 * scale:y1 * scale] = to_uint8(sr[(y0 - top) * scale:(y1 - top) * scale])
+        print("[*] rows %d-%d / %d" % (y0, y1, h))
+    if threshold is not None:
+        print("[*] %.1f%% of tiles skipped G" % (100. * n_skipped / max(n_tiles, 1)))
+    if hasattr(out, 'flush'):
+        out.flush()
+    del out
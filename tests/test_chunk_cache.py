@@ -0,0 +1,115 @@
+"""ChunkCache / CachedNpyArray against a local directory standing in for the slow mount."""
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+import pytest
+
+from chunk_cache import CachedNpyArray, ChunkCache
+
+ROW_SHAPE = (8, 8, 3)  # 192 bytes per row
+
+
+@pytest.fixture
+def mount(tmp_path):
+    rows = np.random.RandomState(0).randint(0, 256, (100,) + ROW_SHAPE).astype(np.uint8)
+    path = str(tmp_path / 'mount' / 'patches.npy')
+    os.makedirs(os.path.dirname(path))
+    np.save(path, rows)
+    return path, rows
+
+
+def chunk_files(cache):
+    return [n for n in os.listdir(cache.cache_dir) if n.endswith('.chunk')]
+
+
+def wait_for(cond, timeout=10.):
+    deadline = time.time() + timeout
+    while not cond():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_rows_match_source(mount, tmp_path):
+    path, rows = mount
+    cache = ChunkCache(str(tmp_path / 'cache'), chunk_bytes=1000, max_bytes=10**6, readahead=0)
+    arr = CachedNpyArray(path, cache)
+    assert len(arr) == len(rows) and arr.shape == rows.shape and arr.dtype == rows.dtype
+    for i in (0, 1, 5, 37, 99, -1, -100):
+        np.testing.assert_array_equal(arr[i], rows[i])
+    np.testing.assert_array_equal(arr[3:17], rows[3:17])
+    np.testing.assert_array_equal(arr[90:200], rows[90:200])
+    np.testing.assert_array_equal(arr[::7], rows[::7])
+    with pytest.raises(IndexError):
+        arr[100]
+    # a second pass is served from the local chunks
+    misses = cache.misses
+    np.testing.assert_array_equal(arr[0:100], rows)
+    assert cache.misses == misses and cache.hits > 0
+
+
+def test_lru_eviction_under_max_bytes(mount, tmp_path):
+    path, rows = mount
+    chunk = 1000
+    cache = ChunkCache(str(tmp_path / 'cache'), chunk_bytes=chunk, max_bytes=3 * chunk, readahead=0)
+    arr = CachedNpyArray(path, cache)
+    for i in range(len(rows)):
+        np.testing.assert_array_equal(arr[i], rows[i])
+    assert cache.evictions > 0
+    assert len(chunk_files(cache)) <= 3
+    assert sum(os.path.getsize(os.path.join(cache.cache_dir, n)) for n in chunk_files(cache)) <= 3 * chunk
+    # the most recently read chunk survived, the first one was evicted
+    last = (arr.offset + len(rows) * arr.row_bytes - 1) // chunk
+    assert os.path.exists(cache._chunk_path(arr.source, last))
+    assert not os.path.exists(cache._chunk_path(arr.source, 0))
+
+
+def test_cap_is_shared_by_caches_on_one_directory(mount, tmp_path):
+    path, rows = mount
+    chunk = 1000
+    a = ChunkCache(str(tmp_path / 'cache'), chunk_bytes=chunk, max_bytes=4 * chunk, readahead=0)
+    b = ChunkCache(str(tmp_path / 'cache'), chunk_bytes=chunk, max_bytes=4 * chunk, readahead=0)
+    arr_a, arr_b = CachedNpyArray(path, a), CachedNpyArray(path, b)
+    for i in range(0, 50):
+        arr_a[i]
+    for i in range(50, 100):
+        arr_b[i]
+    assert len(chunk_files(a)) <= 4
+
+
+def test_schedule_prefetches_in_order(mount, tmp_path):
+    path, rows = mount
+    cache = ChunkCache(str(tmp_path / 'cache'), chunk_bytes=1000, max_bytes=10**6, readahead=0)
+    arr = CachedNpyArray(path, cache)
+    order = [80, 3, 41]
+    arr.schedule(order)
+    needed = set()
+    for i in order:
+        start = arr.offset + i * arr.row_bytes
+        needed.update(range(start // 1000, (start + arr.row_bytes - 1) // 1000 + 1))
+    assert wait_for(lambda: all(os.path.exists(cache._chunk_path(arr.source, c)) for c in needed))
+    for i in order:
+        np.testing.assert_array_equal(arr[i], rows[i])
+    assert cache.misses == 0 and cache.hits > 0
+
+
+def _read_in_child(arr, q):
+    q.put(int(np.asarray(arr[0:100], dtype=np.int64).sum()))
+
+
+@pytest.mark.skipif('fork' not in mp.get_all_start_methods(), reason='needs the fork start method')
+def test_forked_child_after_prefetch_thread_started(mount, tmp_path):
+    path, rows = mount
+    cache = ChunkCache(str(tmp_path / 'cache'), chunk_bytes=1000, max_bytes=10**6, readahead=4)
+    arr = CachedNpyArray(path, cache)
+    arr[0]  # starts the prefetch thread, as SharedMemoryLoader._start does before forking its workers
+    ctx = mp.get_context('fork')
+    q = ctx.Queue()
+    p = ctx.Process(target=_read_in_child, args=(arr, q))
+    p.start()
+    p.join(30)
+    assert p.exitcode == 0, "the forked reader hung or failed"
+    assert q.get(timeout=5) == int(rows.astype(np.int64).sum())
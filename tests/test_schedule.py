@@ -0,0 +1,81 @@
+import pytest
+
+from schedule import Curriculum, DStepScheduler
+
+
+class Batch(object):
+    def __init__(self, n):
+        self.shape = (n,)
+
+
+def stub_build(n_images):
+    # a dataset of `n_images` images in batches of `batch`, hr only needs a shape
+    return lambda patch, batch: ([(None, Batch(min(batch, n_images - i))) for i in range(0, n_images, batch)],)
+
+
+def run_epochs(curriculum, n_epochs, n_images):
+    step, sizes = 0, []
+    for epoch in range(n_epochs):
+        seen = 0
+        for _, _, hr in curriculum.epoch(epoch, step, n_images):
+            seen += hr.shape[0]
+            step += 1
+        sizes.append(seen)
+    return sizes
+
+
+def test_step_change_on_the_last_batch_does_not_extend_the_epoch():
+    curriculum = Curriculum([(0, 96, 10), (4, 128, 5)], 256, 16, stub_build(40), unit='step')
+    assert run_epochs(curriculum, 3, 40) == [40, 40, 40]
+
+
+def test_step_change_mid_epoch_completes_the_epoch_in_the_new_stage():
+    curriculum = Curriculum([(0, 96, 10), (2, 128, 5)], 256, 16, stub_build(40), unit='step')
+    assert run_epochs(curriculum, 2, 40) == [40, 40]
+    assert curriculum.stage(1, 10) == (128, 5)
+
+
+def adaptive(d_loss, accuracy, **kwargs):
+    scheduler = DStepScheduler('adaptive', **kwargs)
+    scheduler.d_loss, scheduler.accuracy = d_loss, accuracy
+    return scheduler
+
+
+def test_fractional_n_critic_runs_d_every_second_step_starting_with_the_first():
+    scheduler = DStepScheduler('fixed', n_critic=0.5)
+    assert [scheduler.n_steps() for _ in range(6)] == [1, 0, 1, 0, 1, 0]
+
+
+def test_integer_n_critic_runs_that_many_d_steps():
+    scheduler = DStepScheduler('fixed', n_critic=2)
+    assert [scheduler.n_steps() for _ in range(3)] == [2, 2, 2]
+
+
+def test_adaptive_skips_at_most_max_skip_steps_in_a_row():
+    scheduler = adaptive(0.05, 0.99, max_skip=2)
+    assert [scheduler.n_steps() for _ in range(6)] == [0, 0, 1, 0, 0, 1]
+
+
+def test_adaptive_extra_steps_are_capped_at_max_steps():
+    assert [adaptive(1.0, 0.5, max_steps=3).n_steps() for _ in range(2)] == [2, 2]
+    scheduler = adaptive(1.0, 0.5, n_critic=3, max_steps=3)
+    assert [scheduler.n_steps() for _ in range(3)] == [3, 3, 3]
+
+
+def test_adaptive_follows_n_critic_before_the_first_d_loss():
+    scheduler = DStepScheduler('adaptive', n_critic=0.5)
+    assert [scheduler.n_steps() for _ in range(4)] == [1, 0, 1, 0]
+
+
+def test_run_counts_g_and_d_steps():
+    scheduler = DStepScheduler('fixed', n_critic=0.5)
+    calls = []
+    for _ in range(4):
+        scheduler.run(lambda lr, hr: calls.append(lr) or 0.5, 'lr', 'hr')
+    assert (scheduler.g_steps, scheduler.d_steps, len(calls), scheduler.last_loss) == (4, 2, 2, 0.5)
+
+
+@pytest.mark.parametrize('kwargs', [{'n_critic': 0}, {'n_critic': -1}, {'policy': 'random'}])
+def test_invalid_d_schedule_raises(kwargs):
+    with pytest.raises(ValueError):
+        DStepScheduler(**kwargs)
@@ -0,0 +1,77 @@
+"""Texture index of the training patches, used by TrainData to draw informative crops more often.
+
+    python texture_index.py --patches /gdrive/MyDrive/Synla_4096.npy --output texture_index.npz --patch 256 --stride 32
+
+Every candidate crop of `patch` x `patch` pixels on a `stride` grid of every stored image is scored by its
+mean luma gradient energy. Scores are computed from an integral image, so the whole pass is one read of the array.
+"""
+import numpy as np
+
+from shards import open_patches
+
+
+def gradient_energy(img):
+    luma = np.asarray(img, dtype=np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32) / 255.
+    energy = np.zeros_like(luma)
+    energy[:-1, :] += np.abs(np.diff(luma, axis=0))
+    energy[:, :-1] += np.abs(np.diff(luma, axis=1))
+    return energy
+
+
+def patch_scores(img, patch, stride):
+    """Mean gradient energy of every `patch` x `patch` crop whose corner lies on the `stride` grid."""
+    energy = gradient_energy(img)
+    integral = np.pad(energy.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    ys = np.arange(0, energy.shape[0] - patch + 1, stride)
+    xs = np.arange(0, energy.shape[1] - patch + 1, stride)
+    sums = integral[np.ix_(ys + patch, xs + patch)] - integral[np.ix_(ys, xs + patch)] - integral[np.ix_(ys + patch, xs)] + integral[np.ix_(ys, xs)]
+    return sums / float(patch * patch)
+
+
+def build_index(patches_path, output, patch=256, stride=32):
+    patches = open_patches(patches_path)
+    scores = None
+    for i, img in enumerate(patches):
+        s = patch_scores(img, patch, stride)
+        if scores is None:
+            scores = np.empty((len(patches),) + s.shape, dtype=np.float16)
+        scores[i] = s
+        if i % 512 == 0:
+            print("[*] scored %d / %d" % (i, len(patches)))
+    np.savez(output, scores=scores, patch=patch, stride=stride)
+    print("[*] %d candidates, mean score %.4f, saved to %s" % (scores.size, float(scores.astype(np.float32).mean()), output))
+
+
+class TextureSampler(object):
+    """Draws (image, y, x) crop positions with probability proportional to their texture score.
+
+    Scores are normalized by the maximum and clipped from below at `floor`, so flat crops are still drawn,
+    just less often (floor=1 gives uniform sampling).
+    """
+
+    def __init__(self, index_path, floor=0.1):
+        index = np.load(index_path)
+        self.patch = int(index['patch'])
+        self.stride = int(index['stride'])
+        scores = index['scores'].astype(np.float32)
+        self.shape = scores.shape
+        weights = np.maximum(scores / max(float(scores.max()), 1e-12), floor).ravel()
+        self.probs = weights / weights.sum()
+
+    def sample(self, n, rng=np.random):
+        flat = rng.choice(len(self.probs), size=n, p=self.probs)
+        i, gy, gx = np.unravel_index(flat, self.shape)
+        return zip(i, gy * self.stride, gx * self.stride)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--patches', type=str, required=True, help='.npy array of HR patches or a patch shard glob')
+    parser.add_argument('--output', type=str, default='texture_index.npz')
+    parser.add_argument('--patch', type=int, default=256, help='HR crop size, must match config.TRAIN.patch_size')
+    parser.add_argument('--stride', type=int, default=32)
+    args = parser.parse_args()
+
+    build_index(args.patches, args.output, args.patch, args.stride)
@@ -10,8 +10,23 @@ import tensorflow as tf
 import cv2
 
 from tensorlayerx.dataflow import Dataset, DataLoader
-from srgan import SRGAN_g, SRGAN_d
-from config import config
+from srgan import SRGAN_g, SRGAN_d, SRGAN_g_multiscale, AtScale, TailOf
+from video import upscale_video
+from batch_infer import upscale_directory
+from stripio import upscale_strips
+from inference import to_uint8, tiled_upscale, adaptive_upscale
+from sr_cache import SRCache
+from model_holder import ModelHolder, CheckpointWatcher, load_weights_in_order
+import profiling
+from texture_index import TextureSampler
+from data import PatchDataset, SharedMemoryLoader, degrade_lr
+from shards import ShardedPatches, open_patches
+from chunk_cache import ChunkCache
+from preview import PreviewWriter
+from schedule import Curriculum, DStepScheduler
+from gan_losses import WithLoss_D
+from valid_cache import TrunkCache, ValidCache, fixed_batches, vgg_input
+from config import config, load_run_config, save_run_config
 from utils import *
 from tensorlayerx.vision.transforms import Compose, RandomCrop, Normalize, RandomFlipHorizontal, Resize, HWC2CHW
 import vgg
@@ -25,9 +40,16 @@ np_config.enable_numpy_behavior()
 # tlx.set_device('GPU')
 
 ###====================== HYPER-PARAMETERS ===========================###
-batch_size = 32
+load_run_config(config, config.TRAIN.run_config)
+batch_size = config.TRAIN.batch_size
+patch_size = config.TRAIN.patch_size
 n_epoch_init = config.TRAIN.n_epoch_init
 n_epoch = config.TRAIN.n_epoch
+chunk_cache = None
+if config.TRAIN.chunk_cache_dir is not None:
+    chunk_cache = ChunkCache(
+        config.TRAIN.chunk_cache_dir, config.TRAIN.chunk_bytes, config.TRAIN.chunk_cache_max_bytes, config.TRAIN.chunk_readahead
+    )
 # create folders to save result images and trained models
 save_dir = "samples"
 tlx.files.exists_or_mkdir(save_dir)
@@ -45,18 +67,65 @@ nor = Normalize(mean=(127.5), std=(127.5), data_format='HWC')
 # train_hr_imgs = tlx.vision.load_images(path=config.TRAIN.hr_img_path, n_threads = 32)
 dataset_signature = tf.TensorSpec(shape=(256, 256, 3), dtype=tf.uint8)
 
-def TrainData(mode = "Train"):
+def texture_weighted_patches(patches):
+    # one epoch draws len(patches) crops, each generator call (i.e. each epoch) draws a new set
+    sampler = TextureSampler(config.TRAIN.texture_index, config.TRAIN.texture_floor)
+    if sampler.patch != patch_size:
+        raise ValueError("texture index was built for %d crops, patch_size is %d" % (sampler.patch, patch_size))
+
+    def crops():
+        positions = list(sampler.sample(len(patches)))
+        if hasattr(patches, 'schedule'):
+            patches.schedule([i for i, _, _ in positions])
+        for i, y, x in positions:
+            yield patches[i][y:y + patch_size, x:x + patch_size]
+
+    signature = tf.TensorSpec(shape=(patch_size, patch_size, 3), dtype=tf.uint8)
+    return tf.data.Dataset.from_generator(crops, output_signature=signature)
+
+def patch_source(patches):
+    """A dataset of the stored patches. Shards are read and decoded in a parallel map, one patch per call."""
+    if not isinstance(patches, ShardedPatches):
+        return tf.data.Dataset.from_generator(lambda: patches, output_signature=(dataset_signature))
+    read = lambda i: tf.ensure_shape(tf.numpy_function(lambda j: patches[int(j)], [i], tf.uint8), dataset_signature.shape)
+    return tf.data.Dataset.range(len(patches)).map(read, num_parallel_calls=tf.data.AUTOTUNE)
+
+def TrainData(mode = "Train", loader = None, crop = None, batch = None, patches = None):
+    """`crop` / `batch` override patch_size / batch_size for training data, e.g. for a curriculum stage, `patches` config.TRAIN.patches."""
+    loader = loader or config.TRAIN.data_loader
+    crop = crop or patch_size
+    batch = batch or batch_size
+    patches = patches or config.TRAIN.patches
+    if loader == 'auto':
+        loader = 'tf' if tlx.BACKEND == 'tensorflow' else 'shm'
+    if loader != 'tf':
+        train = mode == "Train"
+        dataset = PatchDataset(
+            patches if train else config.VALID.patches, train=train, patch_size=crop, cache=chunk_cache
+        )
+        if loader == 'shm':
+            return SharedMemoryLoader(dataset, batch, num_workers=config.TRAIN.data_workers, shuffle=train, drop_last=False)
+        return DataLoader(dataset, batch_size=batch, shuffle=train, drop_last=False)
+
     if mode == "Train":
-      np_synla_4096 = np.load("/gdrive/MyDrive/Synla_4096.npy", mmap_mode='r')
-      train_hr_imgs = tf.data.Dataset.from_generator(lambda: np_synla_4096, output_signature=(dataset_signature))
+      np_synla_4096 = open_patches(patches, chunk_cache)
+      # the texture index scores the crops of config.TRAIN.patches, not of an overriding array
+      if config.TRAIN.texture_index is not None and patches == config.TRAIN.patches:
+          train_hr_imgs = texture_weighted_patches(np_synla_4096)
+          source_size = patch_size
+      else:
+          train_hr_imgs = patch_source(np_synla_4096)
+          source_size = dataset_signature.shape[0]
+      if crop < source_size:
+          train_hr_imgs = train_hr_imgs.map(lambda img: tf.image.random_crop(img, (crop, crop, 3)))
       dataset = train_hr_imgs.map(augment_images, num_parallel_calls=tf.data.AUTOTUNE)
-      dataset = dataset.batch(batch_size)
+      dataset = dataset.batch(batch)
       # dataset = dataset.shuffle(4096 // batch_size)
     else:
-      np_synla_1024 = np.load("/gdrive/MyDrive/Synla_1024.npy", mmap_mode='r')
-      train_hr_imgs = tf.data.Dataset.from_generator(lambda: np_synla_1024, output_signature=(dataset_signature))
+      np_synla_1024 = open_patches(config.VALID.patches, chunk_cache)
+      train_hr_imgs = patch_source(np_synla_1024)
       dataset = train_hr_imgs.map(augment_images_valid, num_parallel_calls=tf.data.AUTOTUNE)
-      dataset = dataset.batch(batch_size)
+      dataset = dataset.batch(batch)
       # dataset = dataset.shuffle(1024 // batch_size)
 
     dataset = dataset.prefetch(tf.data.AUTOTUNE)
@@ -69,30 +138,13 @@ class WithLoss_init(Module):
         self.loss_fn = loss_fn
 
     def forward(self, lr, hr):
-        out = self.net(lr)
-        loss = self.loss_fn(out, hr)
+        with profiling.scope('G'):
+            out = self.net(lr)
+        with profiling.scope('loss'):
+            loss = self.loss_fn(out, hr)
         return loss
 
 
-class WithLoss_D(Module):
-    def __init__(self, D_net, G_net, loss_fn):
-        super(WithLoss_D, self).__init__()
-        self.D_net = D_net
-        self.G_net = G_net
-        self.loss_fn = loss_fn
-
-    def forward(self, lr, hr):
-        fake_patchs = self.G_net(lr)
-        logits_fake = self.D_net(fake_patchs)
-        logits_real = self.D_net(hr)
-        d_loss1 = self.loss_fn(logits_real, tlx.ones_like(logits_real))
-        d_loss1 = tlx.ops.reduce_mean(d_loss1)
-        d_loss2 = self.loss_fn(logits_fake, tlx.zeros_like(logits_fake))
-        d_loss2 = tlx.ops.reduce_mean(d_loss2)
-        d_loss = d_loss1 + d_loss2
-        return d_loss
-
-
 class WithLoss_G(Module):
     def __init__(self, D_net, G_net, vgg, loss_fn1, loss_fn2):
         super(WithLoss_G, self).__init__()
@@ -103,20 +155,44 @@ class WithLoss_G(Module):
         self.loss_fn2 = loss_fn2
 
     def forward(self, lr, hr):
-        fake_patchs = self.G_net(lr)
-        logits_fake = self.D_net(fake_patchs)
-        feature_fake = self.vgg((fake_patchs + 1) / 2.)
-        feature_real = self.vgg((hr + 1) / 2.)
-        g_gan_loss = 1e-3 * self.loss_fn1(logits_fake, tlx.ones_like(logits_fake))
-        g_gan_loss = tlx.ops.reduce_mean(g_gan_loss)
-        mse_loss = self.loss_fn2(fake_patchs, hr)
-        vgg_loss = 2e-6 * self.loss_fn2(feature_fake, feature_real)
-        g_loss = mse_loss + vgg_loss + g_gan_loss
+        with profiling.scope('G'):
+            fake_patchs = self.G_net(lr)
+        with profiling.scope('D'):
+            logits_fake = self.D_net(fake_patchs)
+        with profiling.scope('VGG'):
+            feature_fake = self.vgg((fake_patchs + 1) / 2.)
+            feature_real = self.vgg((hr + 1) / 2.)
+        with profiling.scope('loss'):
+            g_gan_loss = 1e-3 * self.loss_fn1(logits_fake, tlx.ones_like(logits_fake))
+            g_gan_loss = tlx.ops.reduce_mean(g_gan_loss)
+            mse_loss = self.loss_fn2(fake_patchs, hr)
+            vgg_loss = 2e-6 * self.loss_fn2(feature_fake, feature_real)
+            g_loss = mse_loss + vgg_loss + g_gan_loss
         return g_loss
 
 
+class WithLoss_distill(Module):
+    def __init__(self, S_net, adapter, loss_fn, hr_weight, feature_weight):
+        super(WithLoss_distill, self).__init__()
+        self.S_net = S_net
+        self.adapter = adapter
+        self.loss_fn = loss_fn
+        self.hr_weight = hr_weight
+        self.feature_weight = feature_weight
+
+    def forward(self, lr, target):
+        # the teacher runs outside of the gradient computation, its outputs come in with the label
+        hr, teacher_out, teacher_feature = target
+        feature, temp = self.S_net.trunk(lr)
+        out = self.S_net.tail(feature, temp)
+        out_loss = self.loss_fn(out, teacher_out)
+        hr_loss = self.hr_weight * self.loss_fn(out, hr)
+        feature_loss = self.feature_weight * self.loss_fn(self.adapter(feature), teacher_feature)
+        return out_loss + hr_loss + feature_loss
+
+
 G = SRGAN_g()
-D = SRGAN_d()
+D = SRGAN_d(dim=config.TRAIN.d_dim, n_layers=config.TRAIN.d_layers, patch=config.TRAIN.d_patch)
 VGG = vgg.VGG19(pretrained=True, end_with='pool4', mode='dynamic')
 # automatic init layers weights shape with input tensor.
 # Calculating and filling 'in_channels' of each layer is a very troublesome thing.
@@ -124,12 +200,14 @@ VGG = vgg.VGG19(pretrained=True, end_with='pool4', mode='dynamic')
 G.init_build(tlx.nn.Input(shape=(None, None, None, 3)))
 D.init_build(tlx.nn.Input(shape=(None, None, None, 3)))
 
-def train():
+def d_scheduler():
+    return DStepScheduler(config.TRAIN.d_schedule, config.TRAIN.n_critic, **config.TRAIN.d_adaptive)
+
+def train(tracer=None):
     G.set_train()
     D.set_train()
     VGG.set_eval()
 
-    train_ds = TrainData()
     train_ds_img_nums = 4096
 
     lr_v = tlx.optimizers.lr.StepDecay(learning_rate=0.05, step_size=1000, gamma=0.1, last_epoch=-1, verbose=True)
@@ -143,17 +221,47 @@ def train():
     net_with_loss_G = WithLoss_G(D_net=D, G_net=G, vgg=VGG, loss_fn1=tlx.losses.sigmoid_cross_entropy,
                                  loss_fn2=tlx.losses.mean_squared_error)
 
-    trainforinit = TrainOneStep(net_with_loss_init, optimizer=g_optimizer_init, train_weights=g_weights)
-    trainforG = TrainOneStep(net_with_loss_G, optimizer=g_optimizer, train_weights=g_weights)
-    trainforD = TrainOneStep(net_with_loss_D, optimizer=d_optimizer, train_weights=d_weights)
+    # every curriculum stage gets its own data and TrainOneStep objects (so compiled steps are traced for its
+    # shapes), the losses, optimizers and lr_v are shared by all stages
+    def init_stage(crop, batch):
+        return TrainData(crop=crop, batch=batch), TrainOneStep(net_with_loss_init, optimizer=g_optimizer_init, train_weights=g_weights)
+
+    def adv_stage(crop, batch):
+        return (
+            TrainData(crop=crop, batch=batch), TrainOneStep(net_with_loss_G, optimizer=g_optimizer, train_weights=g_weights),
+            TrainOneStep(net_with_loss_D, optimizer=d_optimizer, train_weights=d_weights)
+        )
+
+    unit = config.TRAIN.curriculum_unit
+    init_curriculum = Curriculum(config.TRAIN.curriculum_init, patch_size, batch_size, init_stage, unit, 'init')
+    adv_curriculum = Curriculum(config.TRAIN.curriculum_adv, patch_size, batch_size, adv_stage, unit, 'adv')
+    if len(adv_curriculum.sizes) > 1 and not config.TRAIN.d_patch:
+        raise ValueError("changing crop sizes in the adversarial phase needs the patch discriminator, set config.TRAIN.d_patch = True")
+
+    d_schedule = d_scheduler()
+
+    preview = None
+    if config.TRAIN.preview_every:
+        try:
+            preview = PreviewWriter(
+                lambda: SRGAN_g(), save_dir, config.VALID.patches, n_images=config.TRAIN.preview_n, every=config.TRAIN.preview_every
+            )
+        except (OSError, ValueError) as e:
+            print("[!] no previews, cannot open the validation patches %s: %s" % (config.VALID.patches, e))
 
     # initialize learning (G)
     print("initialize learning")
-    n_step_epoch = round(train_ds_img_nums // batch_size)
+    global_step = 0
     for epoch in range(n_epoch_init):
-        for step, (lr_patch, hr_patch) in enumerate(train_ds):
+        n_step_epoch = round(train_ds_img_nums // init_curriculum.stage(epoch, global_step)[1])
+        for step, ((_, trainforinit), lr_patch, hr_patch) in enumerate(init_curriculum.epoch(epoch, global_step, train_ds_img_nums)):
+            if tracer is not None:
+                tracer.step('init', global_step)
+            global_step += 1
             step_time = time.time()
             loss = trainforinit(lr_patch, hr_patch)
+            if preview is not None:
+                preview.maybe_write(G, global_step, 'init_%07d' % global_step)
             if step % 64 == 0:
               psnr_p = psnr_torch(G(lr_patch), hr_patch)
               print("Epoch: [{}/{}] step: [{}/{}] time: {:.3f}s, mse: {:.3f}, psnr: {:.3f} ".format(
@@ -161,50 +269,90 @@ def train():
         if (epoch != 0) and (epoch % 10 == 0):
             G.save_weights(os.path.join(checkpoint_dir, 'g.npz'), format='npz_dict')
             D.save_weights(os.path.join(checkpoint_dir, 'd.npz'), format='npz_dict')
+        if chunk_cache is not None:
+            chunk_cache.report()
+
+    if tracer is not None:
+        tracer.close()
 
     # adversarial learning (G, D)
-    n_step_epoch = round(train_ds_img_nums // batch_size)
+    global_step = 0
     for epoch in range(n_epoch):
-        for step, (lr_patch, hr_patch) in enumerate(train_ds):
+        n_step_epoch = round(train_ds_img_nums // adv_curriculum.stage(epoch, global_step)[1])
+        for step, ((_, trainforG, trainforD), lr_patch, hr_patch) in enumerate(adv_curriculum.epoch(epoch, global_step, train_ds_img_nums)):
+            if tracer is not None:
+                tracer.step('adv', global_step)
+            global_step += 1
             step_time = time.time()
             loss_g = trainforG(lr_patch, hr_patch)
-            loss_d = trainforD(lr_patch, hr_patch)
+            loss_d = d_schedule.run(trainforD, lr_patch, hr_patch, lambda: net_with_loss_D.last_accuracy)
+            if preview is not None:
+                preview.maybe_write(G, global_step, 'adv_%07d' % global_step)
             print(
                 "Epoch: [{}/{}] step: [{}/{}] time: {:.3f}s, g_loss:{:.3f}, d_loss: {:.3f}".format(
                     epoch, n_epoch, step, n_step_epoch, time.time() - step_time, float(loss_g), float(loss_d)))
         # dynamic learning rate update
         lr_v.step()
+        d_schedule.report()
+        if chunk_cache is not None:
+            chunk_cache.report()
 
         if (epoch != 0) and (epoch % 10 == 0):
             G.save_weights(os.path.join(checkpoint_dir, 'g.npz'), format='npz_dict')
             D.save_weights(os.path.join(checkpoint_dir, 'd.npz'), format='npz_dict')
+    if tracer is not None:
+        tracer.close()
+    if preview is not None:
+        preview.close()
+
+def make_cache(scale=None, watch_dir=None):
+    """The output cache of config.INFER.cache_dir. With `watch_dir`, entries are keyed by the weights of the ModelHolder
+    instance that ran them, not by a checkpoint file."""
+    if config.INFER.cache_dir is None:
+        return None
+    settings = {
+        'model': type(G).__name__, 'tile_size': config.INFER.tile_size, 'tile_overlap': config.INFER.tile_overlap
+    }
+    weights_path = os.path.join(checkpoint_dir, 'g.npz')
+    if scale is not None:
+        settings.update(model='SRGAN_g_multiscale', scale=scale)
+        weights_path = multiscale_path()
+    if watch_dir is not None:
+        weights_path = None
+    return SRCache(config.INFER.cache_dir, weights_path, settings, config.INFER.cache_max_bytes)
 
 def evaluate():
     ###====================== PRE-LOAD DATA ===========================###
-    valid_hr_imgs = TrainData("Valid")
+    valid = open_valid_cache()
     ###========================LOAD WEIGHTS ============================###
     G.load_weights(os.path.join(checkpoint_dir, 'g.npz'), format='npz_dict')
     G.set_eval()
     imid = 0  # 0: 企鹅  81: 蝴蝶 53: 鸟  64: 古堡
-    valid_lr_img, valid_hr_img = valid_hr_imgs[imid]
+    valid_lr_img = valid.lr[imid]
     # print(valid_hr_img)
     # valid_lr_img = np.asarray(valid_hr_img)
     # hr_size1 = [valid_lr_img.shape[0], valid_lr_img.shape[1]]
     # valid_lr_img = cv2.resize(valid_lr_img, dsize=(hr_size1[1] // 4, hr_size1[0] // 4))
 
     valid_lr_img_tensor = np.asarray(valid_lr_img, dtype=np.float32)
-    valid_lr_img_tensor = valid_lr_img_tensor[np.newaxis, :, :, :]
-    valid_lr_img_tensor= tlx.ops.convert_to_tensor(valid_lr_img_tensor)
     size = [valid_lr_img.shape[0], valid_lr_img.shape[1]]
 
-    out = tlx.ops.convert_to_numpy(G(valid_lr_img_tensor))
-    print("LR size: %s /  generated HR size: %s" % (size, out.shape))  # LR size: (339, 510, 3) /  gen HR size: (1, 1356, 2040, 3)
+    cache = make_cache()
+    key = cache.key(valid_lr_img_tensor) if cache is not None else None
+    out = cache.get(key) if cache is not None else None
+    if out is None:
+        out = tlx.ops.convert_to_numpy(G(tlx.ops.convert_to_tensor(valid_lr_img_tensor[np.newaxis, :, :, :])))
+        # a single clip / cast of the one output image, Image.fromarray takes the uint8 array as is
+        out = to_uint8(out[0])
+        if cache is not None:
+            cache.put(key, out)
+    print("LR size: %s /  generated HR size: %s" % (size, out.shape))  # LR size: (339, 510, 3) /  gen HR size: (1356, 2040, 3)
     print("[*] save images")
-
-    out = np.squeeze(np.clip(((out - 0) / (1 - 0)) * 255, 0, 255).astype(np.uint8), axis=0)
     print(out)
-    img = Image.fromarray(np.clip(np.array(out), 0, 255).astype(np.uint8))
+    img = Image.fromarray(out)
     img.save(os.path.join(save_dir, 'valid_gen.png'), fmt = 'png')
+    if cache is not None:
+        cache.report()
 
     # cv2.imwrite(os.path.join(save_dir, 'valid_gen.png'), out)
     # cv2.imwrite(os.path.join(save_dir, 'valid_lr.png'), valid_lr_img)
@@ -217,21 +365,517 @@ def evaluate():
     # tlx.vision.save_image(valid_hr_img, file_name='valid_hr.png', path=save_dir)
     # tlx.vision.save_image(out_bicu, file_name='valid_hr_cubic.png', path=save_dir)
 
+def serving_generator(watch_dir=None, scale=None):
+    """Returns (generator, watcher): the trained G, or a ModelHolder that hot-swaps new g.npz files from `watch_dir`.
+
+    With `scale`, the generator is SRGAN_g_multiscale (g_multiscale.npz) presented at that scale.
+    """
+    if scale is None:
+        make_generator, filename = SRGAN_g, 'g.npz'
+    else:
+        make_generator, filename = lambda: AtScale(SRGAN_g_multiscale(scales=config.MULTISCALE.scales), scale), 'g_multiscale.npz'
+    if watch_dir is None:
+        if scale is None:
+            G.load_weights(os.path.join(checkpoint_dir, filename), format='npz_dict')
+            G.set_eval()
+            return G, None
+        net = make_generator()
+        net.init_build(tlx.nn.Input(shape=(None, None, None, 3)))
+        load_weights_in_order(net, os.path.join(checkpoint_dir, filename))
+        net.set_eval()
+        return net, None
+    tile = config.INFER.tile_size
+    holder = ModelHolder(make_generator, os.path.join(watch_dir, filename), warmup_shape=(config.INFER.batch_size, tile, tile, 3))
+    return holder, CheckpointWatcher(holder, watch_dir, filename=filename, interval=config.INFER.watch_interval)
+
+def open_valid_cache():
+    """ValidCache of config.VALID.patches, the validation images of the eval, validate, adaptive and distill-report modes."""
+    VGG.set_eval()
+    return ValidCache.open(config.VALID.cache_dir, config.VALID.patches, VGG, batch_size)
+
+def validate():
+    """PSNR of G and of bicubic, and the VGG pool4 distance of G to HR, on the cached validation set."""
+    G.load_weights(os.path.join(checkpoint_dir, 'g.npz'), format='npz_dict')
+    G.set_eval()
+    VGG.set_eval()
+    cache = open_valid_cache()
+    start = time.time()
+    psnr_g, vgg_dist = 0., 0.
+    for lr, hr, hr_vgg, _ in cache.batches(batch_size):
+        out = G(tlx.ops.convert_to_tensor(lr))
+        feat = tlx.convert_to_numpy(VGG(vgg_input(out)))
+        psnr_g += float(psnr_torch(out, hr)) * len(lr)
+        vgg_dist += float(np.mean((feat - hr_vgg) ** 2)) * len(lr)
+    n = float(len(cache))
+    print("[*] %d images in %.2fs, psnr: %.3f (bicubic %.3f), vgg pool4 mse: %.5f" % (
+        len(cache), time.time() - start, psnr_g / n, np.mean(cache.meta['bicubic_psnr']), vgg_dist / n))
+
+def upscale_video_file(src, dst, watch_dir=None, scale=None):
+    cache = make_cache(scale, watch_dir)
+    net, watcher = serving_generator(watch_dir, scale)
+    try:
+        upscale_video(
+            net, src, dst, batch_size=config.INFER.batch_size, tile=config.INFER.tile_size, overlap=config.INFER.tile_overlap,
+            queue_size=config.VIDEO.queue_size, fourcc=config.VIDEO.fourcc, scale=scale or 4, cache=cache
+        )
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+def upscale_images(src, dst, watch_dir=None, scale=None):
+    cache = make_cache(scale, watch_dir)
+    net, watcher = serving_generator(watch_dir, scale)
+    try:
+        upscale_directory(
+            net, src, dst, fmt=config.INFER.format, batch_size=config.INFER.batch_size, tile=config.INFER.tile_size,
+            overlap=config.INFER.tile_overlap, decode_workers=config.INFER.decode_workers, encode_workers=config.INFER.encode_workers,
+            queue_size=config.INFER.queue_size, jpeg_quality=config.INFER.jpeg_quality, png_compression=config.INFER.png_compression,
+            scale=scale or 4, cache=cache
+        )
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+def upscale_large_image(src, dst):
+    G.load_weights(os.path.join(checkpoint_dir, 'g.npz'), format='npz_dict')
+    G.set_eval()
+    upscale_strips(
+        G, src, dst, strip_rows=config.INFER.strip_rows, tile=config.INFER.tile_size, overlap=config.INFER.tile_overlap,
+        batch_size=config.INFER.batch_size, threshold=config.ADAPTIVE.threshold
+    )
+
+def adaptive_tradeoff():
+    """Reports skipped tiles, PSNR and latency of adaptive inference at each of config.ADAPTIVE.thresholds."""
+    G.load_weights(os.path.join(checkpoint_dir, 'g.npz'), format='npz_dict')
+    G.set_eval()
+    tile, overlap = config.ADAPTIVE.tile_size, config.ADAPTIVE.tile_overlap
+    pairs, bicubic = [], []
+    for lr_batch, hr_batch, _, bicubic_batch in open_valid_cache().batches(batch_size, config.ADAPTIVE.n_images):
+        pairs.extend(zip(lr_batch, hr_batch))
+        bicubic.extend(bicubic_batch)
+    full = [tiled_upscale(G, lr, tile, overlap, config.INFER.batch_size) for lr, _ in pairs]
+
+    n = float(len(pairs))
+    print("threshold  skipped  psnr(hr)  psnr(full G)  latency")
+    # every tile skipped: the cached bicubic upscales
+    psnr_hr = sum(float(psnr_torch(b, hr)) for b, (_, hr) in zip(bicubic, pairs))
+    psnr_full = sum(float(psnr_torch(b, ref)) for b, ref in zip(bicubic, full))
+    print("%9s  %6.1f%%  %8.3f  %12.3f  %8s" % ('bicubic', 100., psnr_hr / n, psnr_full / n, '-'))
+    for threshold in config.ADAPTIVE.thresholds:
+        skipped, tiles, psnr_hr, psnr_full, elapsed = 0, 0, 0., 0., 0.
+        for (lr, hr), ref in zip(pairs, full):
+            start = time.time()
+            out, n_skipped, n_tiles = adaptive_upscale(G, lr, threshold, tile, overlap, config.INFER.batch_size)
+            elapsed += time.time() - start
+            out = np.clip(out, 0, 1)
+            skipped += n_skipped
+            tiles += n_tiles
+            psnr_hr += float(psnr_torch(out, hr))
+            psnr_full += float(psnr_torch(out, ref))
+        print("%9.3f  %6.1f%%  %8.3f  %12.3f  %6.1fms" % (threshold, 100. * skipped / tiles, psnr_hr / n, psnr_full / n, 1000 * elapsed / n))
+
+def profile_data(n_batches, step_time):
+    """Drains TrainData() without a model and breaks the cost down per augmentation."""
+    patches = open_patches(config.TRAIN.patches, chunk_cache)
+    n_source = min(len(patches), n_batches * batch_size)
+    start = time.perf_counter()
+    for i in range(n_source):
+        np.array(patches[i])
+    source_rate = n_source / (time.perf_counter() - start)
+
+    if isinstance(patches, ShardedPatches):
+        source = 'shard read + decode, one thread'
+    else:
+        source = 'chunk cache read' if chunk_cache is not None else 'memmap read'
+    print("[*] source (%s): %.1f images/sec" % (source, source_rate))
+    if chunk_cache is not None:
+        chunk_cache.report()
+    loaders = (['tf'] if tlx.BACKEND == 'tensorflow' else []) + ['shm']
+    rates = {}
+    for loader in loaders:
+        dataset = TrainData(loader=loader)
+        n_images, elapsed = profiling.drain(dataset, n_batches)
+        if hasattr(dataset, 'close'):
+            dataset.close()
+        rates[loader] = n_images / elapsed
+        print("[*] TrainData pipeline (%s): %.1f images/sec (%d images in %.2fs)" % (loader, rates[loader], n_images, elapsed))
+    default = config.TRAIN.data_loader if config.TRAIN.data_loader in rates else loaders[0]
+    rate = rates[default]
+
+    print("%-16s %5s %10s %14s" % ("transform", "p", "ms/call", "ms/image"))
+    rows = profiling.profile_transforms(patches[:16])
+    for name, prob, ms, expected in rows:
+        print("%-16s %5.2f %10.3f %14.3f" % (name, prob, ms, expected))
+    print("%-16s %5s %10s %14.3f (single core)" % ("total", "", "", sum(r[3] for r in rows)))
+
+    stall = profiling.stall_fraction(rate, batch_size, step_time)
+    print("[*] at %.3fs per model step and batch size %d the trainer would stall %.1f%% of the time" % (step_time, batch_size, 100 * stall))
+
+def student_path(n_blocks, n_channels):
+    return os.path.join(checkpoint_dir, 'g_student_%dx%d.npz' % (n_blocks, n_channels))
+
+def distill():
+    """Trains a compact SRGAN_g student on the outputs and residual trunk features of the trained teacher G."""
+    G.load_weights(os.path.join(checkpoint_dir, 'g.npz'), format='npz_dict')
+    G.set_eval()
+    n_blocks, n_channels = config.DISTILL.n_blocks, config.DISTILL.n_channels
+    S = SRGAN_g(n_blocks=n_blocks, n_channels=n_channels)
+    S.init_build(tlx.nn.Input(shape=(None, None, None, 3)))
+    # 1x1 conv mapping the student trunk features to the teacher width
+    adapter = tlx.nn.Conv2d(out_channels=64, kernel_size=(1, 1), stride=(1, 1), padding='SAME', data_format='channels_last')
+    adapter.init_build(tlx.nn.Input(shape=(None, None, None, n_channels)))
+    S.set_train()
+
+    optimizer = tlx.optimizers.Adam(config.TRAIN.lr_init, beta_1=config.TRAIN.beta1)
+    net_with_loss = WithLoss_distill(
+        S, adapter, loss_fn=tlx.losses.mean_squared_error, hr_weight=config.DISTILL.hr_weight,
+        feature_weight=config.DISTILL.feature_weight
+    )
+    trainforS = TrainOneStep(net_with_loss, optimizer=optimizer, train_weights=S.trainable_weights + adapter.trainable_weights)
+
+    train_ds = TrainData()
+    n_step_epoch = round(4096 // batch_size)
+    for epoch in range(config.DISTILL.n_epoch):
+        for step, (lr_patch, hr_patch) in enumerate(train_ds):
+            step_time = time.time()
+            teacher_feature, temp = G.trunk(lr_patch)
+            teacher_out = G.tail(teacher_feature, temp)
+            loss = trainforS(lr_patch, (hr_patch, teacher_out, teacher_feature))
+            if step % 64 == 0:
+                psnr_s = psnr_torch(S(lr_patch), hr_patch)
+                psnr_t = psnr_torch(teacher_out, hr_patch)
+                print("Epoch: [{}/{}] step: [{}/{}] time: {:.3f}s, loss: {:.5f}, psnr: {:.3f} (teacher {:.3f})".format(
+                    epoch, config.DISTILL.n_epoch, step, n_step_epoch, time.time() - step_time, float(loss), float(psnr_s),
+                    float(psnr_t)))
+        if (epoch != 0) and (epoch % 10 == 0):
+            S.save_weights(student_path(n_blocks, n_channels), format='npz_dict')
+    S.save_weights(student_path(n_blocks, n_channels), format='npz_dict')
+
+def distill_report():
+    """Prints latency and PSNR gap to the teacher for each of config.DISTILL.variants."""
+    G.load_weights(os.path.join(checkpoint_dir, 'g.npz'), format='npz_dict')
+    G.set_eval()
+    valid_cache = open_valid_cache()
+    valid = [(tlx.convert_to_tensor(lr), hr) for lr, hr, _, _ in valid_cache.batches(batch_size, config.DISTILL.report_batches * batch_size)]
+    bicubic_psnr = np.mean(valid_cache.meta['bicubic_psnr'][:config.DISTILL.report_batches * batch_size])
+    x = tlx.ops.convert_to_tensor(np.random.uniform(0, 1, config.DISTILL.report_shape).astype(np.float32))
+
+    def measure(net):
+        net(x)
+        start = time.perf_counter()
+        for _ in range(10):
+            tlx.ops.convert_to_numpy(net(x))
+        latency = (time.perf_counter() - start) / 10
+        psnr = np.mean([float(psnr_torch(net(lr), hr)) for lr, hr in valid])
+        return latency, psnr
+
+    t_latency, t_psnr = measure(G)
+    print("| blocks | channels | params | latency (ms) | speedup | PSNR | gap to teacher |")
+    print("|--------|----------|--------|--------------|---------|------|----------------|")
+    print("| bicubic | - | 0 | - | - | %.3f | %.3f |" % (bicubic_psnr, t_psnr - bicubic_psnr))
+    print("| 16 (teacher) | 64 | %d | %.2f | 1.00x | %.3f | - |" % (
+        sum(int(np.prod(tlx.get_tensor_shape(w))) for w in G.trainable_weights), 1000 * t_latency, t_psnr))
+    for n_blocks, n_channels in config.DISTILL.variants:
+        S = SRGAN_g(n_blocks=n_blocks, n_channels=n_channels)
+        S.init_build(tlx.nn.Input(shape=(None, None, None, 3)))
+        trained = os.path.exists(student_path(n_blocks, n_channels))
+        if trained:
+            load_weights_in_order(S, student_path(n_blocks, n_channels))
+        S.set_eval()
+        latency, psnr = measure(S)
+        print("| %d | %d | %d | %.2f | %.2fx | %s | %s |" % (
+            n_blocks, n_channels, sum(int(np.prod(tlx.get_tensor_shape(w))) for w in S.trainable_weights), 1000 * latency,
+            t_latency / latency, "%.3f" % psnr if trained else "untrained", "%.3f" % (t_psnr - psnr) if trained else "-"))
+
+def multiscale_path():
+    return os.path.join(checkpoint_dir, 'g_multiscale.npz')
+
+def multiscale_batch(lr_patch, hr_patch, scale, hr_size, rng=np.random):
+    """Crops a TrainData batch to `hr_size` HR pixels and returns the (lr, hr) pair for `scale`.
+
+    x4 keeps the degraded LR of the pipeline (cropped from the same corner). x2 / x3 inputs are made on the
+    host from the HR crop with `data.degrade_lr`, the same ring / blur / downscale / JPEG chain at that scale,
+    so every head is trained on one degradation model. The HR crop is the pipeline's, which went through
+    JPEG 95 when the x4 LR drew JPEG rather than when the x2 / x3 LR did.
+    """
+    hr = np.ascontiguousarray(tlx.convert_to_numpy(hr_patch)[:, :hr_size, :hr_size])
+    if scale == 4:
+        lr = np.ascontiguousarray(tlx.convert_to_numpy(lr_patch)[:, :hr_size // 4, :hr_size // 4])
+    else:
+        lr = np.stack([degrade_lr(img, scale, rng)[0] for img in hr])
+    return tlx.convert_to_tensor(lr), tlx.convert_to_tensor(hr)
+
+def train_multiscale():
+    """Trains SRGAN_g_multiscale, drawing one of config.MULTISCALE.scales for every batch.
+
+    HR crops are cut to a multiple of every scale so that D always sees the same size. Each scale has its own
+    TrainOneStep over the shared trunk and its head; the G optimizers are per scale too, because an optimizer
+    may not be applied to different variable lists, while D and its optimizer are shared.
+    """
+    scales = config.MULTISCALE.scales
+    step_size = int(np.lcm.reduce(scales))
+    hr_size = patch_size // step_size * step_size
+    Gm = SRGAN_g_multiscale(scales=scales)
+    Dm = SRGAN_d(dim=config.TRAIN.d_dim, n_layers=config.TRAIN.d_layers, patch=config.TRAIN.d_patch)
+    Gm.init_build(tlx.nn.Input(shape=(None, None, None, 3)))
+    Dm.init_build(tlx.nn.Input(shape=(batch_size, hr_size, hr_size, 3)))
+    Gm.set_train()
+    Dm.set_train()
+    VGG.set_eval()
+
+    lr_v = tlx.optimizers.lr.StepDecay(learning_rate=0.05, step_size=1000, gamma=0.1, last_epoch=-1, verbose=True)
+    d_optimizer = tlx.optimizers.Momentum(lr_v, 0.9)
+    trainforinit, trainforG, trainforD, d_losses = {}, {}, {}, {}
+    for scale in scales:
+        view = AtScale(Gm, scale)
+        weights = Gm.scale_weights(scale)
+        trainforinit[scale] = TrainOneStep(
+            WithLoss_init(view, loss_fn=tlx.losses.mean_squared_error), optimizer=tlx.optimizers.Momentum(lr_v, 0.9), train_weights=weights
+        )
+        trainforG[scale] = TrainOneStep(
+            WithLoss_G(D_net=Dm, G_net=view, vgg=VGG, loss_fn1=tlx.losses.sigmoid_cross_entropy, loss_fn2=tlx.losses.mean_squared_error),
+            optimizer=tlx.optimizers.Momentum(lr_v, 0.9), train_weights=weights
+        )
+        d_losses[scale] = WithLoss_D(D_net=Dm, G_net=view, loss_fn=tlx.losses.sigmoid_cross_entropy)
+        trainforD[scale] = TrainOneStep(d_losses[scale], optimizer=d_optimizer, train_weights=Dm.trainable_weights)
+
+    train_ds = TrainData()
+    rng = np.random.RandomState()
+    n_step_epoch = round(4096 // batch_size)
+    print("initialize learning, scales %s, HR crops of %d" % (scales, hr_size))
+    for epoch in range(config.MULTISCALE.n_epoch_init):
+        for step, (lr_patch, hr_patch) in enumerate(train_ds):
+            step_time = time.time()
+            scale = scales[rng.randint(len(scales))]
+            lr, hr = multiscale_batch(lr_patch, hr_patch, scale, hr_size, rng)
+            loss = trainforinit[scale](lr, hr)
+            if step % 64 == 0:
+                print("Epoch: [{}/{}] step: [{}/{}] x{} time: {:.3f}s, mse: {:.3f}".format(
+                    epoch, config.MULTISCALE.n_epoch_init, step, n_step_epoch, scale, time.time() - step_time, float(loss)))
+        if (epoch != 0) and (epoch % 10 == 0):
+            Gm.save_weights(multiscale_path(), format='npz_dict')
+
+    d_schedule = d_scheduler()
+    for epoch in range(config.MULTISCALE.n_epoch):
+        for step, (lr_patch, hr_patch) in enumerate(train_ds):
+            step_time = time.time()
+            scale = scales[rng.randint(len(scales))]
+            lr, hr = multiscale_batch(lr_patch, hr_patch, scale, hr_size, rng)
+            loss_g = trainforG[scale](lr, hr)
+            loss_d = d_schedule.run(trainforD[scale], lr, hr, lambda: d_losses[scale].last_accuracy)
+            print("Epoch: [{}/{}] step: [{}/{}] x{} time: {:.3f}s, g_loss:{:.3f}, d_loss: {:.3f}".format(
+                epoch, config.MULTISCALE.n_epoch, step, n_step_epoch, scale, time.time() - step_time, float(loss_g), float(loss_d)))
+        lr_v.step()
+        d_schedule.report()
+        if (epoch != 0) and (epoch % 10 == 0):
+            Gm.save_weights(multiscale_path(), format='npz_dict')
+            Dm.save_weights(os.path.join(checkpoint_dir, 'd_multiscale.npz'), format='npz_dict')
+    Gm.save_weights(multiscale_path(), format='npz_dict')
+    Dm.save_weights(os.path.join(checkpoint_dir, 'd_multiscale.npz'), format='npz_dict')
+
+def finetune():
+    """Fine-tunes the trained G on config.FINETUNE.patches with conv1 and the residual blocks frozen.
+
+    Only the tail (conv2 / bn1 and the upsampling convs) is trained, on the (features, skip) pair the frozen
+    trunk computes outside the train step. Without augmentation the pair of a patch never changes, so with
+    config.FINETUNE.cache_dir it is computed once into a TrunkCache and every epoch runs the tail only.
+    """
+    cfg = config.FINETUNE
+    weights_path = os.path.join(checkpoint_dir, 'g.npz')
+    patches = cfg.patches or config.TRAIN.patches
+    G.load_weights(weights_path, format='npz_dict')
+    G.set_train()
+    G.conv1.set_eval()
+    G.residual_block.set_eval()
+    tail = TailOf(G)
+
+    optimizer = tlx.optimizers.Adam(cfg.lr, beta_1=config.TRAIN.beta1)
+    if cfg.adversarial and not cfg.augment and not config.TRAIN.d_patch and open_patches(patches).shape[1] != patch_size:
+        raise ValueError("without augmentation whole patches are used, which the dense D only takes at patch_size, set config.TRAIN.d_patch = True")
+    if cfg.adversarial:
+        D.load_weights(os.path.join(checkpoint_dir, 'd.npz'), format='npz_dict')
+        D.set_train()
+        VGG.set_eval()
+        net_with_loss_D = WithLoss_D(D_net=D, G_net=tail, loss_fn=tlx.losses.sigmoid_cross_entropy)
+        trainforD = TrainOneStep(net_with_loss_D, optimizer=tlx.optimizers.Adam(cfg.lr, beta_1=config.TRAIN.beta1), train_weights=D.trainable_weights)
+        net_with_loss = WithLoss_G(D_net=D, G_net=tail, vgg=VGG, loss_fn1=tlx.losses.sigmoid_cross_entropy, loss_fn2=tlx.losses.mean_squared_error)
+        d_schedule = d_scheduler()
+    else:
+        net_with_loss = WithLoss_init(tail, loss_fn=tlx.losses.mean_squared_error)
+    trainforG = TrainOneStep(net_with_loss, optimizer=optimizer, train_weights=G.tail_weights())
+    print("[*] fine-tuning %d of %d weights on %s" % (len(G.tail_weights()), len(G.trainable_weights), patches))
+
+    def frozen_trunk(lr):
+        # through the host, so that no backend tracks gradients into the frozen trunk
+        return tuple(tlx.convert_to_tensor(tlx.convert_to_numpy(t)) for t in G.trunk(tlx.convert_to_tensor(lr)))
+
+    if cfg.augment:
+        train_ds = TrainData(batch=cfg.batch_size, patches=patches)
+        epoch_batches = lambda: ((frozen_trunk(lr), hr) for lr, hr in train_ds)
+    elif cfg.cache_dir:
+        cache = TrunkCache.open(cfg.cache_dir, patches, G, cfg.batch_size, weights_path=weights_path)
+        epoch_batches = lambda: cache.batches(cfg.batch_size)
+    else:
+        source = open_patches(patches, chunk_cache)
+        epoch_batches = lambda: ((frozen_trunk(lr), hr) for lr, hr in fixed_batches(source, cfg.batch_size))
+
+    output = os.path.join(checkpoint_dir, cfg.output)
+    for epoch in range(cfg.n_epoch):
+        epoch_time = time.time()
+        for step, (features, hr_patch) in enumerate(epoch_batches()):
+            step_time = time.time()
+            features = tuple(tlx.convert_to_tensor(f) for f in features)
+            hr_patch = tlx.convert_to_tensor(hr_patch)
+            loss = trainforG(features, hr_patch)
+            if cfg.adversarial:
+                d_schedule.run(trainforD, features, hr_patch, lambda: net_with_loss_D.last_accuracy)
+            if step % 64 == 0:
+                print("Epoch: [{}/{}] step: {} time: {:.3f}s, loss: {:.5f}, psnr: {:.3f}".format(
+                    epoch, cfg.n_epoch, step, time.time() - step_time, float(loss), float(psnr_torch(tail(features), hr_patch))))
+        print("[*] epoch %d took %.1fs" % (epoch, time.time() - epoch_time))
+        if cfg.adversarial:
+            d_schedule.report()
+        if (epoch != 0) and (epoch % 10 == 0):
+            G.save_weights(output, format='npz_dict')
+    G.save_weights(output, format='npz_dict')
+    print("[*] fine-tuned generator saved to %s" % output)
+
+def tune_trial(patch, bs):
+    """Times config.TUNE.steps adversarial steps at one batch / patch size, returns (seconds per step, peak bytes) or None on OOM."""
+    from benchmark import peak_memory_bytes, reset_peak_memory
+
+    VGG.set_eval()
+    g, d = SRGAN_g(), SRGAN_d(dim=config.TRAIN.d_dim, n_layers=config.TRAIN.d_layers, patch=config.TRAIN.d_patch)
+    g.init_build(tlx.nn.Input(shape=(bs, patch // 4, patch // 4, 3)))
+    d.init_build(tlx.nn.Input(shape=(bs, patch, patch, 3)))
+    g.set_train()
+    d.set_train()
+    step_g = TrainOneStep(
+        WithLoss_G(D_net=d, G_net=g, vgg=VGG, loss_fn1=tlx.losses.sigmoid_cross_entropy, loss_fn2=tlx.losses.mean_squared_error),
+        optimizer=tlx.optimizers.Momentum(1e-4, 0.9), train_weights=g.trainable_weights
+    )
+    step_d = TrainOneStep(
+        WithLoss_D(D_net=d, G_net=g, loss_fn=tlx.losses.sigmoid_cross_entropy), optimizer=tlx.optimizers.Momentum(1e-4, 0.9),
+        train_weights=d.trainable_weights
+    )
+    lr = tlx.ops.convert_to_tensor(np.random.uniform(0, 1, (bs, patch // 4, patch // 4, 3)).astype(np.float32))
+    hr = tlx.ops.convert_to_tensor(np.random.uniform(0, 1, (bs, patch, patch, 3)).astype(np.float32))
+    try:
+        reset_peak_memory()
+        float(step_g(lr, hr)), float(step_d(lr, hr))  # warm up
+        start = time.perf_counter()
+        for _ in range(config.TUNE.steps):
+            float(step_g(lr, hr)), float(step_d(lr, hr))
+        elapsed = (time.perf_counter() - start) / config.TUNE.steps
+        return elapsed, peak_memory_bytes()
+    except Exception as e:
+        if 'out of memory' not in str(e).lower() and 'ResourceExhausted' not in type(e).__name__:
+            raise
+        return None
+
+def tune():
+    """Picks the batch and patch size with the best images/sec whose adversarial step fits in config.TUNE.memory_limit_mb.
+
+    Every trial builds fresh G and D (D's Linear head depends on the patch size) and runs config.TUNE.steps full
+    trainforG + trainforD steps on random data. Peak memory is the device peak on GPU. On CPU the only counter
+    is the process peak RSS, which never decreases, so there every trial runs in a fresh spawned process and
+    its peak includes the models and the framework; a trial the OS kills counts as out of memory.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    import multiprocessing as mp
+
+    from benchmark import has_device_memory_stats
+
+    def run_trial(patch, bs):
+        if has_device_memory_stats():
+            return tune_trial(patch, bs)
+        try:
+            with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as pool:
+                return pool.submit(tune_trial, patch, bs).result()
+        except BrokenProcessPool:
+            return None
+
+    limit = config.TUNE.memory_limit_mb * 2**20
+    results = []
+    for patch in config.TUNE.patch_sizes:
+        if patch > dataset_signature.shape[0]:
+            continue
+        for bs in sorted(config.TUNE.batch_sizes):
+            trial = run_trial(patch, bs)
+            if trial is None:
+                print("patch: %d batch: %d out of memory" % (patch, bs))
+                break
+            elapsed, peak = trial
+            print("patch: %d batch: %d step: %.3fs %.1f images/sec peak memory: %.0fMB" % (patch, bs, elapsed, bs / elapsed, peak / 2**20))
+            if peak > limit:
+                break
+            results.append({'batch_size': bs, 'patch_size': patch, 'images_per_sec': bs / elapsed, 'peak_memory_mb': peak / 2**20})
+    if not results:
+        raise RuntimeError("no configuration fits in %dMB" % config.TUNE.memory_limit_mb)
+    best = max(results, key=lambda r: r['images_per_sec'])
+    save_run_config(config.TRAIN.run_config, {'batch_size': best['batch_size'], 'patch_size': best['patch_size']})
+    print("[*] best: batch %d, patch %d (%.1f images/sec), saved to %s" % (
+        best['batch_size'], best['patch_size'], best['images_per_sec'], config.TRAIN.run_config))
+    return best
 
 if __name__ == '__main__':
     import argparse
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('--mode', type=str, default='train', help='train, eval')
+    parser.add_argument(
+        '--mode', type=str, default='train',
+        help='train, eval, validate, video, infer, strip, adaptive, profile-data, distill, distill-report, tune, train-multiscale,'
+             ' finetune'
+    )
+    parser.add_argument('--input', type=str, default=None, help='input file for video / strip mode, directory or glob for infer mode')
+    parser.add_argument('--output', type=str, default=None, help='output file for video / strip mode, directory for infer mode')
+    parser.add_argument('--n_batches', type=int, default=50, help='batches drained by profile-data')
+    parser.add_argument('--step_time', type=float, default=0.25, help='model step time (s) used to estimate data stalls')
+    parser.add_argument('--profile_phase', type=str, default=None, help='capture a trace during init or adv training')
+    parser.add_argument('--profile_start', type=int, default=10, help='first traced step of the phase')
+    parser.add_argument('--profile_steps', type=int, default=5, help='number of traced steps')
+    parser.add_argument('--profile_dir', type=str, default='runs', help='traces go to <profile_dir>/profile-<time>')
+    parser.add_argument('--watch_dir', type=str, default=None, help='video / infer mode: serve g.npz from this directory and hot-swap it when it changes')
+    parser.add_argument('--scale', type=int, default=None, help='video / infer mode: use models/g_multiscale.npz at this scale (2, 3 or 4)')
+    parser.add_argument('--cache_dir', type=str, default=None, help='super-resolved output cache, overrides config.INFER.cache_dir')
 
     args = parser.parse_args()
 
     tlx.global_flag['mode'] = args.mode
+    if args.cache_dir is not None:
+        config.INFER.cache_dir = args.cache_dir
 
     if tlx.global_flag['mode'] == 'train':
-        train()
+        tracer = None
+        if args.profile_phase is not None:
+            logdir = os.path.join(args.profile_dir, time.strftime('profile-%Y%m%d-%H%M%S'))
+            tracer = profiling.TraceWindow(args.profile_phase, args.profile_start, args.profile_steps, logdir)
+        train(tracer)
     elif tlx.global_flag['mode'] == 'eval':
         evaluate()
+    elif tlx.global_flag['mode'] == 'validate':
+        validate()
+    elif tlx.global_flag['mode'] == 'video':
+        upscale_video_file(args.input, args.output, args.watch_dir, args.scale)
+    elif tlx.global_flag['mode'] == 'infer':
+        upscale_images(args.input, args.output, args.watch_dir, args.scale)
+    elif tlx.global_flag['mode'] == 'strip':
+        upscale_large_image(args.input, args.output)
+    elif tlx.global_flag['mode'] == 'adaptive':
+        adaptive_tradeoff()
+    elif tlx.global_flag['mode'] == 'profile-data':
+        profile_data(args.n_batches, args.step_time)
+    elif tlx.global_flag['mode'] == 'distill':
+        distill()
+    elif tlx.global_flag['mode'] == 'distill-report':
+        distill_report()
+    elif tlx.global_flag['mode'] == 'tune':
+        tune()
+    elif tlx.global_flag['mode'] == 'train-multiscale':
+        train_multiscale()
+    elif tlx.global_flag['mode'] == 'finetune':
+        finetune()
     else:
         raise Exception("Unknow --mode")
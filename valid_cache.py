@@ -0,0 +1,168 @@
+import glob
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+import tensorlayerx as tlx
+
+from shards import is_sharded, open_patches
+from utils import augment_images_valid, psnr_torch
+
+META = 'meta.json'
+
+
+def source_stamp(path):
+    """Path, size and mtime of a file, or of every shard of a shard glob."""
+    paths = sorted(glob.glob(path)) if is_sharded(path) else [path]
+    return [{'path': os.path.abspath(p), 'size': os.stat(p).st_size, 'mtime_ns': os.stat(p).st_mtime_ns} for p in paths]
+
+
+def vgg_input(img):
+    # same scaling as the perceptual term of WithLoss_G
+    return (img + 1) / 2.
+
+
+def fixed_pairs(patches):
+    """float32 (lr, hr) tensors of a batch of uint8 patches with the fixed bicubic x4 degradation of augment_images_valid."""
+    return augment_images_valid(tf.convert_to_tensor(np.asarray(patches), dtype=tf.float32))
+
+
+class MemmapCache(object):
+    """Arrays computed once per patch of `patches_path` into memory-mapped .npy files in `cache_dir`.
+
+    Subclasses list their arrays in `ARRAYS` as (name, dtype) and compute them for a batch of fixed
+    (`fixed_pairs`) LR / HR tensors in `compute(model, lr, hr)`, which returns the arrays and per-image values
+    for meta.json. HR images are not stored, they are read from the source array itself. The cache is rebuilt
+    when the source (or `weights_path`, when given) changes size or mtime; meta.json is written last, so an
+    interrupted build is never mistaken for a complete one.
+    """
+
+    ARRAYS = ()
+
+    def __init__(self, cache_dir, patches_path):
+        with open(os.path.join(cache_dir, META)) as f:
+            self.meta = json.load(f)
+        self.hr = open_patches(patches_path)
+        for name, _ in self.ARRAYS:
+            setattr(self, name, np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r'))
+
+    @staticmethod
+    def _stamp(patches_path, weights_path=None):
+        return {'source': source_stamp(patches_path), 'weights': source_stamp(weights_path) if weights_path else None}
+
+    @classmethod
+    def is_current(cls, cache_dir, patches_path, weights_path=None):
+        try:
+            with open(os.path.join(cache_dir, META)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return all(meta.get(k) == v for k, v in cls._stamp(patches_path, weights_path).items())
+
+    @classmethod
+    def compute(cls, model, lr, hr):
+        raise NotImplementedError
+
+    @classmethod
+    def build(cls, cache_dir, patches_path, model, batch_size=16, weights_path=None):
+        os.makedirs(cache_dir, exist_ok=True)
+        meta_path = os.path.join(cache_dir, META)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        patches = open_patches(patches_path)
+        n = len(patches)
+        files, meta = None, dict(cls._stamp(patches_path, weights_path), n_images=n)
+        for i in range(0, n, batch_size):
+            lr, hr = fixed_pairs(patches[i:i + batch_size])
+            arrays, values = cls.compute(model, lr, hr)
+            if files is None:
+                files = {
+                    name: np.lib.format.open_memmap(
+                        os.path.join(cache_dir, name + '.npy'), mode='w+', dtype=dtype, shape=(n,) + arrays[name].shape[1:]
+                    ) for name, dtype in cls.ARRAYS
+                }
+            for name, arr in arrays.items():
+                files[name][i:i + len(arr)] = arr
+            for k, v in values.items():
+                meta.setdefault(k, []).extend(v)
+        size = 0
+        for arr in files.values():
+            arr.flush()
+            size += arr.nbytes
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+        print("[*] %s of %d images written to %s (%.1fMB)" % (cls.__name__, n, cache_dir, size / 2**20))
+
+    @classmethod
+    def open(cls, cache_dir, patches_path, model, batch_size=16, weights_path=None):
+        """Returns the cache in `cache_dir`, building it first if it is missing or out of date."""
+        if not cls.is_current(cache_dir, patches_path, weights_path):
+            cls.build(cache_dir, patches_path, model, batch_size, weights_path)
+        return cls(cache_dir, patches_path)
+
+    def __len__(self):
+        return self.meta['n_images']
+
+    def hr_batch(self, idx):
+        """float32 HR images at the (sorted) indices `idx`."""
+        return np.stack([self.hr[int(j)] for j in idx]).astype(np.float32) / 255.
+
+
+class ValidCache(MemmapCache):
+    """Validation inputs and references of `config.VALID.patches`, see MemmapCache.
+
+    lr (float32 LR inputs), bicubic (float16 bicubic upscales of the LR), hr_vgg (float16 VGG19 pool4 features of
+    the HR images) and the per-image bicubic PSNR in meta.json.
+    """
+
+    ARRAYS = (('lr', np.float32), ('bicubic', np.float16), ('hr_vgg', np.float16))
+
+    @classmethod
+    def compute(cls, vgg_net, lr, hr):
+        up = tf.clip_by_value(tf.image.resize(lr, tf.shape(hr)[1:3], method="bicubic"), 0, 1)
+        feat = tlx.convert_to_numpy(vgg_net(tlx.convert_to_tensor(vgg_input(hr.numpy()))))
+        psnr = [float(psnr_torch(up[j:j + 1], hr[j:j + 1])) for j in range(len(feat))]
+        return {'lr': lr.numpy(), 'bicubic': up.numpy(), 'hr_vgg': feat}, {'bicubic_psnr': psnr}
+
+    def batches(self, batch_size, n=None):
+        """Yields (lr, hr, hr_vgg, bicubic) float32 batches of the first `n` (all) images; nothing is recomputed but the
+        /255 of the HR images."""
+        n = len(self) if n is None else min(n, len(self))
+        for i in range(0, n, batch_size):
+            j = min(i + batch_size, n)
+            yield (
+                np.asarray(self.lr[i:j]), np.asarray(self.hr[i:j], dtype=np.float32) / 255., np.asarray(self.hr_vgg[i:j], dtype=np.float32),
+                np.asarray(self.bicubic[i:j], dtype=np.float32)
+            )
+
+
+class TrunkCache(MemmapCache):
+    """Outputs of a frozen SRGAN_g trunk for every patch, for `--mode finetune`, see MemmapCache.
+
+    feature and skip (float16) are the two outputs of `SRGAN_g.trunk`, 2 * 2 * C bytes per LR pixel: about 1MB per
+    256x256 patch for the 64 channel trunk. Built with the generator's `weights_path`, so a new g.npz rebuilds it.
+    """
+
+    ARRAYS = (('feature', np.float16), ('skip', np.float16))
+
+    @classmethod
+    def compute(cls, G, lr, hr):
+        feature, skip = (tlx.convert_to_numpy(t) for t in G.trunk(tlx.convert_to_tensor(lr.numpy())))
+        return {'feature': feature, 'skip': skip}, {}
+
+    def batches(self, batch_size, rng=np.random):
+        """Yields shuffled float32 ((feature, skip), hr) batches, reading rows of a batch in file order."""
+        order = rng.permutation(len(self))
+        for i in range(0, len(order), batch_size):
+            idx = np.sort(order[i:i + batch_size])
+            yield (np.asarray(self.feature[idx], dtype=np.float32), np.asarray(self.skip[idx], dtype=np.float32)), self.hr_batch(idx)
+
+
+def fixed_batches(patches, batch_size, rng=np.random):
+    """Yields shuffled (lr, hr) batches of `patches` with the fixed degradation of `fixed_pairs`, no augmentation."""
+    order = rng.permutation(len(patches))
+    for i in range(0, len(order), batch_size):
+        idx = np.sort(order[i:i + batch_size])
+        yield fixed_pairs(np.stack([patches[int(j)] for j in idx]))
@@ -0,0 +1,127 @@
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from inference import StageMeter, report_stages, upscale_batch
+from model_holder import borrow
+from sr_cache import cached_upscale
+
+_EOS = None  # end of stream marker passed through the queues
+
+
+def _put(q, item, stop):
+    # never block forever on a full queue once another stage has failed
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _EOS
+
+
+def _read_frames(cap, out_q, meter, stop, errors):
+    try:
+        while not stop.is_set():
+            with meter.busy():
+                ok, frame = cap.read()
+                if ok:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.
+            if not ok:
+                break
+            if not _put(out_q, frame, stop):
+                break
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        cap.release()
+        _put(out_q, _EOS, stop)
+
+
+def _write_frames(writer, in_q, meter, stop, errors):
+    try:
+        while True:
+            frame = _get(in_q, stop)
+            if frame is _EOS:
+                break
+            with meter.busy():
+                writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        writer.release()
+
+
+def upscale_video(G, src, dst, batch_size=8, tile=128, overlap=8, queue_size=16, fourcc='mp4v', scale=4, cache=None):
+    """Super-resolves a video file with G.
+
+    Frames are decoded in a reader thread and encoded in a writer thread while the calling thread runs G,
+    so the three stages overlap. The bounded queues between them keep memory flat regardless of video length.
+    Frames that fit in one tile are batched together, larger frames are tiled and their tiles batched instead.
+    Frames found in `cache` (an `SRCache`) skip G. G may be a `ModelHolder`, weights are then swapped between batches.
+    """
+    cap = cv2.VideoCapture(src)
+    if not cap.isOpened():
+        raise IOError("cannot open video %s" % src)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.
+    w, h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    writer = cv2.VideoWriter(dst, cv2.VideoWriter_fourcc(*fourcc), fps, (w * scale, h * scale))
+    if not writer.isOpened():
+        cap.release()
+        raise IOError("cannot open video writer for %s" % dst)
+
+    decoded, generated = queue.Queue(queue_size), queue.Queue(queue_size)
+    read_meter, infer_meter, write_meter = StageMeter('decode'), StageMeter('infer'), StageMeter('encode')
+    stop, errors = threading.Event(), []
+    reader = threading.Thread(target=_read_frames, args=(cap, decoded, read_meter, stop, errors), daemon=True)
+    writer_thread = threading.Thread(target=_write_frames, args=(writer, generated, write_meter, stop, errors), daemon=True)
+
+    start = time.perf_counter()
+    reader.start()
+    writer_thread.start()
+    n_frames, eos = 0, False
+    try:
+        while not eos and not stop.is_set():
+            frames = []
+            while len(frames) < batch_size:
+                frame = _get(decoded, stop)
+                if frame is _EOS:
+                    eos = True
+                    break
+                frames.append(frame)
+            if not frames:
+                break
+            with infer_meter.busy(len(frames)), borrow(G) as (g, weights_id):
+                outs = cached_upscale(cache, frames, lambda imgs: upscale_batch(g, imgs, tile, overlap, batch_size, scale), weights_id)
+            for out in outs:
+                if not _put(generated, out, stop):
+                    break
+            n_frames += len(frames)
+    except Exception:
+        stop.set()
+        raise
+    finally:
+        _put(generated, _EOS, stop)
+        reader.join()
+        writer_thread.join()
+    if errors:
+        raise errors[0]
+
+    report_stages([read_meter, infer_meter, write_meter], time.perf_counter() - start, n_frames)
+    if cache is not None:
+        cache.report()
+    return n_frames